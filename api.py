@@ -0,0 +1,308 @@
+"""
+E-ComMate HTTP API：把工作流开放给其它系统调用，Streamlit 之外的入口。
+
+    uvicorn api:app --host 0.0.0.0 --port 8000
+
+接口 (图片均以 multipart 上传，只在内存中流转，不落盘)：
+    POST /v1/generate          同步生成，返回最终文案
+    POST /v1/generate/stream   SSE 流式返回 step / token / cached / done 事件
+    POST /v1/jobs              提交后台任务，立即返回 job_id (队列满时 429)
+    GET  /v1/jobs/{job_id}     查询任务状态与结果
+    GET  /metrics              Prometheus 指标
+每个来源地址同时进行的请求数受 API_CLIENT_MAX_CONCURRENCY 限制 (部署在反向代理后时用 uvicorn --proxy-headers
+取真实地址)；请求头 X-Client-Id 只作为日志与任务记录里的标签，不参与限流。
+"""
+import asyncio
+import json
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Dict
+
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi.responses import PlainTextResponse, StreamingResponse
+
+import config
+from core.metrics import render_prometheus, start_trace
+from core.prompt import warmup_tokenizer
+from core.rag import warmup_rag
+from core.workflow import astream_workflow, get_workflow
+
+
+class ClientLimiter:
+    """按调用方统计进行中的请求 (含排队中的任务)，超过上限直接拒绝"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._active = {}
+
+    def acquire(self, client: str) -> bool:
+        if self._active.get(client, 0) >= self.limit:
+            return False
+        self._active[client] = self._active.get(client, 0) + 1
+        return True
+
+    def release(self, client: str) -> None:
+        remaining = self._active.get(client, 0) - 1
+        if remaining > 0:
+            self._active[client] = remaining
+        else:
+            self._active.pop(client, None)
+
+
+_limiter = ClientLimiter(config.API_CLIENT_MAX_CONCURRENCY)
+_jobs: Dict[str, Dict] = {}
+_queue: asyncio.Queue = None
+
+
+def client_id(request: Request) -> str:
+    """限流用的调用方标识：来源地址。X-Client-Id 由调用方随意填写，换个值就能绕过限制，不能用作 key"""
+    return request.client.host if request.client else "unknown"
+
+
+def client_label(request: Request) -> str:
+    """日志里显示的调用方名字 (X-Client-Id，缺省为来源地址)"""
+    return request.headers.get("X-Client-Id") or client_id(request)
+
+
+class SlotStreamingResponse(StreamingResponse):
+    """
+    流式响应结束时一定释放调用方名额：客户端在 body 开始迭代前断开时，
+    生成器的 finally 不会执行，因此在响应外层再释放一次 (release 需幂等)。
+    """
+
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self._release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._release()
+
+
+def slot_releaser(client: str):
+    """返回只生效一次的释放函数"""
+    released = False
+
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            _limiter.release(client)
+
+    return release
+
+
+def acquire_slot(client: str) -> None:
+    if not _limiter.acquire(client):
+        raise HTTPException(
+            status_code=429,
+            detail=f"调用方 {client} 同时进行的请求已达上限 ({config.API_CLIENT_MAX_CONCURRENCY})",
+            headers={"Retry-After": "5"},
+        )
+
+
+async def read_inputs(image: UploadFile, user_style: str, words_limit: str, user_note: str) -> Dict:
+    image_bytes = await image.read()
+    if not image_bytes:
+        raise HTTPException(status_code=400, detail="图片为空")
+    if len(image_bytes) > config.API_MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail=f"图片超过 {config.API_MAX_IMAGE_BYTES // 1024 // 1024}MB 上限")
+    return {
+        "image_path": image.filename or "",
+        "image_bytes": image_bytes,
+        "user_style": user_style,
+        "words_limit": words_limit,
+        "user_note": user_note,
+        "image_data": {},
+        "retrieved_examples": [],
+        "final_copy": "",
+    }
+
+
+def public_result(state: Dict, cached: bool) -> Dict:
+    """返回给调用方的结果 (不回传图片字节)"""
+    return {
+        "final_copy": state.get("final_copy", ""),
+        "image_data": state.get("image_data", {}),
+        "retrieved_examples": state.get("retrieved_examples", []),
+        "cached": cached,
+        "degraded": bool(state.get("degraded") or state.get("vision_failed")),  # 使用了降级模型或视觉解析失败
+        "vision_failed": bool(state.get("vision_failed")),  # 文案基于占位属性生成，失败原因见 image_data.error
+    }
+
+
+async def run_generation(inputs: Dict, regenerate: bool = False) -> Dict:
+    """完整跑一次工作流 (经过生成结果缓存与请求去重)"""
+    start_trace()
+    cached, final_state = False, {}
+    async for kind, payload in astream_workflow(get_workflow(), inputs, regenerate=regenerate):
+        if kind == "cached":
+            cached = True
+        elif kind == "done":
+            final_state = payload
+    return public_result(final_state, cached)
+
+
+def prune_jobs() -> None:
+    now = time.time()
+    expired = [
+        job_id for job_id, job in _jobs.items()
+        if job.get("finished_at") and now - job["finished_at"] > config.API_JOB_TTL
+    ]
+    for job_id in expired:
+        del _jobs[job_id]
+
+
+async def job_worker():
+    while True:
+        job_id, inputs, regenerate = await _queue.get()
+        job = _jobs.get(job_id)
+        try:
+            if job is None:
+                continue
+            job["status"] = "running"
+            job["started_at"] = time.time()
+            try:
+                job["result"] = await run_generation(inputs, regenerate)
+                job["status"] = "done"
+            except Exception as e:
+                print(f"后台任务 {job_id} ({job['client_label']}) 失败: {e}")
+                job["status"] = "error"
+                job["error"] = str(e)
+            job["finished_at"] = time.time()
+        finally:
+            if job is not None:
+                _limiter.release(job["client"])
+            _queue.task_done()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _queue
+    _queue = asyncio.Queue(maxsize=config.API_QUEUE_SIZE)
+    try:
+        # 预热放到线程池，首次打开向量库不阻塞事件循环
+        await asyncio.to_thread(warmup_rag)
+    except Exception as e:
+        print(f"向量库预热失败: {e}")
+    await asyncio.to_thread(warmup_tokenizer)
+    get_workflow()
+    workers = [asyncio.create_task(job_worker()) for _ in range(config.API_WORKERS)]
+    print(f"API 服务已就绪：{config.API_WORKERS} 个 worker，队列上限 {config.API_QUEUE_SIZE}")
+    yield
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+
+app = FastAPI(title="E-ComMate API", lifespan=lifespan)
+
+
+@app.post("/v1/generate")
+async def generate(
+    request: Request,
+    image: UploadFile = File(...),
+    user_style: str = Form("小红书种草"),
+    words_limit: str = Form("100"),
+    user_note: str = Form(""),
+    regenerate: bool = Form(False),
+):
+    client = client_id(request)
+    inputs = await read_inputs(image, user_style, words_limit, user_note)
+    acquire_slot(client)
+    try:
+        return await run_generation(inputs, regenerate)
+    except Exception as e:
+        print(f"生成失败: {e}")
+        raise HTTPException(status_code=500, detail=f"生成失败: {e}")
+    finally:
+        _limiter.release(client)
+
+
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/v1/generate/stream")
+async def generate_stream(
+    request: Request,
+    image: UploadFile = File(...),
+    user_style: str = Form("小红书种草"),
+    words_limit: str = Form("100"),
+    user_note: str = Form(""),
+    regenerate: bool = Form(False),
+):
+    client = client_id(request)
+    inputs = await read_inputs(image, user_style, words_limit, user_note)
+    acquire_slot(client)
+    release = slot_releaser(client)
+
+    async def events():
+        start_trace()
+        cached = False
+        try:
+            async for kind, payload in astream_workflow(get_workflow(), inputs, regenerate=regenerate):
+                if kind == "step":
+                    yield sse("step", {"node": payload})
+                elif kind == "token":
+                    yield sse("token", {"text": payload})
+                elif kind == "cached":
+                    cached = True
+                    yield sse("cached", {})
+                else:
+                    yield sse("done", public_result(payload, cached))
+        except Exception as e:
+            print(f"流式生成失败: {e}")
+            yield sse("error", {"detail": str(e)})
+        finally:
+            release()
+
+    return SlotStreamingResponse(events(), release, media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.post("/v1/jobs", status_code=202)
+async def submit_job(
+    request: Request,
+    image: UploadFile = File(...),
+    user_style: str = Form("小红书种草"),
+    words_limit: str = Form("100"),
+    user_note: str = Form(""),
+    regenerate: bool = Form(False),
+):
+    client = client_id(request)
+    inputs = await read_inputs(image, user_style, words_limit, user_note)
+    prune_jobs()
+    acquire_slot(client)
+
+    job_id = uuid.uuid4().hex
+    _jobs[job_id] = {"status": "queued", "client": client, "client_label": client_label(request),
+                     "created_at": time.time()}
+    try:
+        # 队列满时不排队等待，直接让调用方稍后重试 (背压)
+        _queue.put_nowait((job_id, inputs, regenerate))
+    except asyncio.QueueFull:
+        del _jobs[job_id]
+        _limiter.release(client)
+        raise HTTPException(status_code=429, detail="任务队列已满，请稍后重试", headers={"Retry-After": "10"})
+    return {"job_id": job_id, "status": "queued", "queue_size": _queue.qsize()}
+
+
+@app.get("/v1/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = _jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    return {"job_id": job_id, **{k: v for k, v in job.items() if k != "client"}}
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok", "queue_size": _queue.qsize() if _queue else 0}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -3,7 +3,13 @@ import os
 import time
 from PIL import Image
 
-from core.workflow import create_workflow
+import config
+from core.blobs import get_blob_store, get_image, put_image
+from core.vision import make_thumbnail
+from core.workflow import get_workflow, run_batch, stream_workflow
+from core.rag import warmup_rag
+from core.metrics import start_metrics_server, start_trace
+from core.prompt import warmup_tokenizer
 
 # 基础页面配置
 st.set_page_config(
@@ -47,12 +53,68 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# SixthCommit新增修改: 流式输出模拟器
-def stream_text_simulator(text):
-    for word in text:
-        yield word
-        time.sleep(0.02)
-        
+# 服务启动预热：cache_resource 保证每个服务进程只执行一次，后续脚本重跑直接复用
+# 返回已编译的工作流；模型客户端与 HTTP 连接池由 core.llm 在进程内统一复用
+@st.cache_resource(show_spinner="正在加载风格知识库...")
+def load_workflow():
+    try:
+        warmup_rag()
+    except Exception as e:
+        # 预热失败不阻塞页面，首次检索时会再次尝试初始化
+        print(f"向量库预热失败: {e}")
+    warmup_tokenizer()
+    start_metrics_server()
+    return get_workflow()
+
+load_workflow()
+
+# 工作流节点名 -> 前端进度提示
+STEP_LABELS = {
+    "vision_step": "视觉特征分析",
+    "retrieve_step": "参考范例检索",
+    "generate_step": "文案撰写",
+}
+
+def render_batch_results(items):
+    """批量模式：每种风格一列，并排展示"""
+    cols = st.columns(len(items))
+    for col, item in zip(cols, items):
+        with col:
+            st.markdown(f"**{item['style']}**")
+            st.markdown(f"""
+            <div class="chat-bubble bot-bubble" style="width: 100%; max-width: 100%;">
+                {item["content"]}
+            </div>
+            """, unsafe_allow_html=True)
+            with st.expander("Debug Info"):
+                st.json(item.get("debug_data", {"info": "无调试数据"}))
+
+def stage_timings(trace):
+    """把一次请求的埋点记录整理成 {阶段: 耗时} 便于展示"""
+    timings = {}
+    for record in trace:
+        if "wall" in record:
+            timings[record["name"]] = {k: v for k, v in record.items() if k not in ("name", "trace_id", "ts")}
+    return timings
+
+def trim_session_images(messages):
+    """
+    每个会话的缩略图总量不超过 SESSION_IMAGE_MAX_BYTES，超出时从最早的图片开始清理，
+    长会话的内存占用保持平稳。
+    """
+    total = 0
+    for msg in reversed(messages):
+        if msg["type"] == "image" and msg.get("content"):
+            total += len(msg["content"])
+            if total > config.SESSION_IMAGE_MAX_BYTES:
+                msg["content"] = None
+
+def node_wall(trace, node_name):
+    for record in reversed(trace):
+        if record["name"] == f"node.{node_name}":
+            return record["wall"]
+    return None
+
 # 初始化状态
 if "messages" not in st.session_state:
     st.session_state.messages = []
@@ -65,7 +127,8 @@ with st.sidebar:
     st.caption("智能电商文案助手")
     
     st.markdown("---")
-    style_option = st.selectbox("文案风格", ["小红书种草", "京东/淘宝电商", "朋友圈私域", "抖音直播"])
+    # 选择多个风格时进入批量模式：同一张图一次生成多平台文案
+    style_options = st.multiselect("文案风格 (可多选)", ["小红书种草", "京东/淘宝电商", "朋友圈私域", "抖音直播"], default=["小红书种草"])
     length_limit = st.slider("篇幅限制", 0, 300, 100, step=20)
     
     st.markdown("---")
@@ -75,14 +138,16 @@ with st.sidebar:
         "朋友圈私域": "特点：像朋友一样聊天、软植入、信任感",
         "抖音直播": "特点：短促有力、甚至有点紧迫感、引导下单"
     }
-    st.info(tips[style_option])
+    for style in style_options:
+        st.info(f"{style}：{tips[style]}")
     
     # refactor: 增加“清空对话”按钮
     if st.button("清空所有对话", use_container_width=True):
         st.session_state.messages = []
-        # 清理可能存在的临时路径状态
-        if "temp_img_path" in st.session_state:
-            del st.session_state.temp_img_path
+        # 清理当前图片状态
+        if "current_image_name" in st.session_state:
+            del st.session_state.current_image_name
+        st.session_state.pop("current_image_ref", None)
         st.rerun()
 
     st.markdown("---")
@@ -119,11 +184,13 @@ for msg in st.session_state.messages:
         # 图片专门显示
         col1, col2 = st.columns([1, 4])
         with col2:
-            # SeventhCommit：兼容读取字节流(bytes)或本地路径。使用字节流摆脱对本地 temp 图片的依赖
+            # 聊天记录里只有缩略图，原图按 image_ref 保存在进程内的 BlobStore 中
             if isinstance(msg["content"], bytes):
                 st.image(msg["content"], width=250)
             elif isinstance(msg["content"], str) and os.path.exists(msg["content"]):
                 st.image(msg["content"], width=250)
+            else:
+                st.caption("(较早的图片已从会话中清理)")
     
     elif msg["type"] == "result":
         st.markdown(f"""
@@ -137,6 +204,9 @@ for msg in st.session_state.messages:
         with st.expander("查看 Vision 解析与参考数据 (Debug Info)"):
             st.json(msg.get("debug_data", {"info": "无调试数据"}))
 
+    elif msg["type"] == "batch_result":
+        render_batch_results(msg["content"])
+
 # 核心生成逻辑 (修改了流式输出和校验)
 if st.session_state.generating:
     st.session_state.generating = False
@@ -145,74 +215,118 @@ if st.session_state.generating:
         # 彻底解决频繁操作 DOM 树导致流式输出触发 removeChild 报错的问题
   
     try:
-        # EighthCommit: 进入生成前，先检查并恢复临时文件，确保图片复用性
-        if not os.path.exists(st.session_state.temp_img_path):
-            last_image_bytes = next((msg["content"] for msg in reversed(st.session_state.messages) if msg["type"] == "image"), None)
-            if last_image_bytes:
-                with open(st.session_state.temp_img_path, "wb") as f:
-                    f.write(last_image_bytes)
+        # 使用聊天记录中最近一张图片的引用，原图从内存中的 BlobStore 取，不经过临时文件
+        last_image_ref = next((msg.get("image_ref") for msg in reversed(st.session_state.messages) if msg["type"] == "image"), None)
+        if not last_image_ref or last_image_ref not in get_blob_store():
+            raise RuntimeError("图片已过期，请重新上传")
     
-        # EighthCommit：简化 st.status 的使用，避免状态框文字堆叠
-        # 不再频繁使用 state="error" 等参数，直接通过 label 更新状态           
-        with st.status("正在处理中...", expanded=True) as status:
-            st.write("正在分析商品特征...")
-            
-            status.update(label="正在分析视觉特征...")
-            time.sleep(0.5) 
-            
-            status.update(label="正在检索参考范例...")
-            time.sleep(0.5)
-            
-            status.update(label="正在撰写最终文案...")
-            
-            if create_workflow:
-                app = create_workflow()
-                inputs = {
-                    "image_path": st.session_state.temp_img_path,
-                    "user_style": style_option,
-                    "words_limit": str(length_limit),
-                    "user_note": st.session_state.get("current_user_note", ""), # 传给 Agent
-                    "image_data": {}, 
-                    "retrieved_examples": [],
-                    "final_copy": ""
-                }
-                res = app.invoke(inputs)
-                
-                # EighthCommit：移除“识别失败”的硬报错
-                image_data = res.get("image_data", {})
-                final_copy = res.get("final_copy", "生成出错")
-                debug_info = {
-                    "vision_analysis": image_data,
-                    "rag_references": res.get("retrieved_examples", [])
+        current_styles = st.session_state.current_styles
+        current_note = st.session_state.get("current_user_note", "")
+        # 点击“重新生成”时跳过结果缓存
+        regenerate = st.session_state.get("current_regenerate", False)
+        # 记录本次生成各阶段的真实耗时 / token / 缓存命中
+        trace = start_trace()
+
+        if len(current_styles) > 1:
+            # 一图多风格：视觉解析只做一次，各风格文案并发生成
+            with st.status(f"正在批量生成 {len(current_styles)} 种风格的文案...", expanded=True) as status:
+                variants = [(style, str(length_limit), current_note) for style in current_styles]
+                results = run_batch(get_image(last_image_ref), variants, regenerate=regenerate)
+                status.update(label="批量文案生成完毕！", expanded=False)
+
+            batch_items = [
+                {
+                    "style": res["user_style"],
+                    "content": res.get("final_copy") or "生成出错",
+                    "debug_data": {
+                        "vision_analysis": res.get("image_data", {}),
+                        "rag_references": res.get("retrieved_examples", []),
+                        "degraded": bool(res.get("degraded") or res.get("vision_failed")),
+                        "timings": stage_timings(trace)
+                    }
                 }
-            else:
-                time.sleep(1)
-                final_copy = "这是演示文案..."
-                debug_info = {"info": "Demo Mode"}
-                
-            # SeventhCommit: 任务完成,更新状态框为完成并折叠
-            status.update(label="文案生成完毕！", expanded=False)
+                for res in results
+            ]
+            render_batch_results(batch_items)
+            st.session_state.messages.append({"role": "bot", "type": "batch_result", "content": batch_items})
+        else:
+            # EighthCommit：简化 st.status 的使用，避免状态框文字堆叠
+            # 不再频繁使用 state="error" 等参数，直接通过 label 更新状态
+            # 状态框根据工作流真实事件更新，收到第一个 token 后折叠，正文转为流式输出
+            app = load_workflow()
+            inputs = {
+                "image_path": st.session_state.current_image_name,
+                "image_ref": last_image_ref,
+                "user_style": current_styles[0],
+                "words_limit": str(length_limit),
+                "user_note": current_note, # 传给 Agent
+                "image_data": {}, 
+                "retrieved_examples": [],
+                "final_copy": ""
+            }
+            events = stream_workflow(app, inputs, regenerate=regenerate)
+            final_state = {}
+            first_token = ""
+            from_cache = False
+            finished_steps = set()
+
+            with st.status("正在分析视觉特征 & 检索参考范例...", expanded=True) as status:
+                for kind, payload in events:
+                    if kind == "step":
+                        st.write(f"{STEP_LABELS.get(payload, payload)} 完成 ({node_wall(trace, payload):.2f}s)")
+                        finished_steps.add(payload)
+                        if {"vision_step", "retrieve_step"} <= finished_steps:
+                            status.update(label="正在撰写最终文案...")
+                    elif kind == "token":
+                        first_token = payload
+                        st.write(f"首个 token 到达 ({time.time() - trace[0]['ts']:.2f}s)")
+                        break
+                    elif kind == "cached":
+                        from_cache = True
+                        st.write("相同请求已生成过，直接返回缓存结果")
+                    else:
+                        final_state = payload
+                status.update(label="正在撰写最终文案...", expanded=False)
+
+            def token_stream():
+                # 把已经取出的第一个 token 接回去，剩余 token 边到边渲染
+                if first_token:
+                    yield first_token
+                for kind, payload in events:
+                    if kind == "token":
+                        yield payload
+                    elif kind == "done":
+                        final_state.update(payload)
+                # 命中缓存时没有 token 事件，整段文案一次性输出
+                if from_cache and final_state.get("final_copy"):
+                    yield final_state["final_copy"]
 
-        # SeventhCommit：删除了 `time.sleep(6)` 和 `status_placeholder.empty()`
-        result_container = st.chat_message("assistant", avatar="🛍️")
-        response_stream = stream_text_simulator(final_copy)
-        # SixthCommit新增修改
-        full_text = result_container.write_stream(response_stream)
+            result_container = st.chat_message("assistant", avatar="🛍️")
+            full_text = result_container.write_stream(token_stream())
+            # EighthCommit：移除“识别失败”的硬报错
+            if not full_text:
+                full_text = final_state.get("final_copy") or "生成出错"
+            debug_info = {
+                "vision_analysis": final_state.get("image_data", {}),
+                "rag_references": final_state.get("retrieved_examples", []),
+                "from_cache": from_cache,
+                "degraded": bool(final_state.get("degraded") or final_state.get("vision_failed")),
+                "vision_failed": bool(final_state.get("vision_failed")),
+                "timings": stage_timings(trace)
+            }
+            status.update(label=f"文案生成完毕！(总耗时 {time.time() - trace[0]['ts']:.1f}s)")
            
-        # [SixthCommit新增/修改逻辑]: 渲染完成后直接在这里显示调试信息
-        with st.expander("查看 Vision 解析与参考数据 (Debug Info)"):
-            st.json(debug_info)
+            # [SixthCommit新增/修改逻辑]: 渲染完成后直接在这里显示调试信息
+            with st.expander("查看 Vision 解析与参考数据 (Debug Info)"):
+                st.json(debug_info)
             
-        # 存入历史并刷新   
-        st.session_state.messages.append({
-            "role": "bot", 
-            "type": "result", 
-            "content": full_text, 
-            "debug_data": debug_info
-        })
-
-        if os.path.exists(st.session_state.temp_img_path):
-            os.remove(st.session_state.temp_img_path)
+            # 存入历史并刷新   
+            st.session_state.messages.append({
+                "role": "bot", 
+                "type": "result", 
+                "content": full_text, 
+                "debug_data": debug_info
+            })
 
         # SeventhCommit：删除之前为 DOM 缓冲留的 0.8s 睡眠时间，让体验更顺滑
         st.rerun()
@@ -235,38 +349,44 @@ with c1:
 with c2:
     st.markdown("<br>", unsafe_allow_html=True) 
     start_btn = st.button("开始生成", use_container_width=True, type="primary")
+    # 相同的图片与参数默认复用上次的结果，想换一版文案时点这里
+    regenerate_btn = st.button("重新生成", use_container_width=True, help="忽略缓存，重新调用模型生成")
 
 st.markdown('</div>', unsafe_allow_html=True)
 
 # 处理上传和点击事件
 if uploaded_file:
-    # 保存文件
-    os.makedirs("temp", exist_ok=True)
-    file_path = os.path.join("temp", uploaded_file.name)
-    
     # SeventhCommit：在这里定义 image_bytes
+    # 原图按内容哈希存入进程内的 BlobStore (同一张图只存一份)，不写入 temp 目录
     image_bytes = uploaded_file.getvalue()
+    image_ref = put_image(image_bytes)
     
-    # 只有当文件是新上传的时候才处理
-    if "temp_img_path" not in st.session_state or st.session_state.temp_img_path != file_path:
-        with open(file_path, "wb") as f:
-            f.write(image_bytes)
-        
-        st.session_state.temp_img_path = file_path
+    # 只有当文件是新上传的时候才处理 (按内容判断，不同用户的同名文件互不影响)
+    if st.session_state.get("current_image_ref") != image_ref:
+        st.session_state.current_image_name = uploaded_file.name
+        st.session_state.current_image_ref = image_ref
         
-        # SeventhCommit：存入聊天记录的是字节流(image_bytes)而非本地路径。这样哪怕后面 `os.remove()` 删了硬盘里的图片，聊天界面的历史记录也照样能渲染出来
-        st.session_state.messages.append({"role": "user", "type": "image", "content": image_bytes})
+        # 聊天记录只保存缩略图 + 引用，不再保存原图字节
+        st.session_state.messages.append({
+            "role": "user", "type": "image",
+            "content": make_thumbnail(image_bytes), "image_ref": image_ref
+        })
+        trim_session_images(st.session_state.messages)
         st.rerun()
 
-if start_btn:
-    if "temp_img_path" not in st.session_state:
+if start_btn or regenerate_btn:
+    if "current_image_name" not in st.session_state:
         st.toast("请先上传一张图片！") 
+    elif not style_options:
+        st.toast("请至少选择一种文案风格！")
     else:
         st.session_state.generating = True
         st.session_state.current_user_note = user_note
+        st.session_state.current_styles = style_options
+        st.session_state.current_regenerate = regenerate_btn
         st.session_state.messages.append({
             "role": "user", 
             "type": "text", 
-            "content": f"要求：{style_option}，约{length_limit}字。备注：{user_note if user_note else '无'}"
+            "content": f"要求：{'、'.join(style_options)}，约{length_limit}字。备注：{user_note if user_note else '无'}"
         })
         st.rerun()
\ No newline at end of file
@@ -0,0 +1,94 @@
+"""
+启动耗时基准：在全新子进程里用 python -X importtime 测量各入口模块的导入耗时，并与预算比较。
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --repeat 5 --out import_time.json
+
+同时检查 langchain_openai / langchain_chroma / langgraph / pandas 等重型依赖没有在导入阶段被加载
+(它们应在首次使用时才导入)。子进程不设置 DASHSCOPE_API_KEY，确认导入本身不依赖 Key。
+超出预算或重型依赖被提前加载时退出码为 1，便于在 CI 中跟踪。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from benchmarks.run_benchmark import PROJECT_ROOT, git_commit
+
+# 入口模块 -> 导入耗时预算 (毫秒)；app.py 导入即运行 Streamlit 页面，这里测它依赖的 core 模块。
+# 预算按单核容器留了余量；重型依赖任意一个被提前导入都会多出 1-2 秒，远超预算
+BUDGETS_MS = {
+    "config": 100,
+    "core.vision": 1000,
+    "core.rag": 1000,
+    "core.workflow": 1200,
+    "api": 2000,
+}
+
+# 只应在首次使用时导入的重型依赖
+LAZY_MODULES = ("langchain_openai", "langchain_chroma", "chromadb", "langgraph", "pandas", "tiktoken")
+
+
+def measure_once(module: str):
+    """返回 (总耗时 ms, {模块名: 累计耗时 ms})"""
+    env = {k: v for k, v in os.environ.items() if k != "DASHSCOPE_API_KEY"}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=PROJECT_ROOT, env=env, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败:\n{result.stderr[-2000:]}")
+
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cum, name = line.split("|")
+        try:
+            cumulative[name.strip()] = int(cum) / 1000
+        except ValueError:
+            # 表头行
+            continue
+    return cumulative.get(module, 0.0), cumulative
+
+
+def main():
+    parser = argparse.ArgumentParser(description="E-ComMate 启动耗时基准")
+    parser.add_argument("--repeat", type=int, default=3, help="每个模块测量次数，取中位数")
+    parser.add_argument("--top", type=int, default=5, help="列出累计耗时最高的依赖数")
+    parser.add_argument("--out", help="结果写入 JSON，便于跨提交对比")
+    args = parser.parse_args()
+
+    results = {}
+    failed = False
+    print(f"{'模块':<18}{'中位数(ms)':>12}{'预算(ms)':>10}")
+    for module, budget in BUDGETS_MS.items():
+        runs = [measure_once(module) for _ in range(args.repeat)]
+        total = statistics.median(t for t, _ in runs)
+        cumulative = runs[-1][1]
+        eager = sorted(name for name in cumulative if name in LAZY_MODULES)
+        ok = total <= budget and not eager
+        failed |= not ok
+        print(f"{module:<18}{total:>12.1f}{budget:>10}  {'OK' if ok else 'OVER BUDGET'}")
+        if eager:
+            print(f"    导入阶段加载了重型依赖: {', '.join(eager)}")
+        heaviest = sorted(
+            ((name, ms) for name, ms in cumulative.items() if name != module and "." not in name),
+            key=lambda item: -item[1],
+        )[:args.top]
+        print("    " + "  ".join(f"{name} {ms:.0f}ms" for name, ms in heaviest))
+        results[module] = {"median_ms": round(total, 1), "budget_ms": budget, "eager_imports": eager}
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"commit": git_commit(), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.out}")
+
+    print(f"\n预算检查 —— {'通过' if not failed else '未通过'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
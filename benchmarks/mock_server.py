@@ -0,0 +1,231 @@
+"""
+本地模拟的 DashScope / OpenAI 兼容服务，用于离线压测，不消耗 API 额度。
+
+实现接口：
+    POST /v1/chat/completions   文本与 image_url 多模态请求，支持 stream=True (SSE)
+    POST /v1/embeddings         返回确定性的伪向量
+
+单独启动：
+    python -m benchmarks.mock_server --port 8765 --text-latency 0.3 --tokens-per-sec 40
+然后设置 LLM_BASE_URL=http://127.0.0.1:8765/v1 即可让 config.BASE_URL 指向它。
+"""
+import argparse
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+VISION_RESULT = {
+    "description": "一件收腰设计的碎花连衣裙，V 领短袖，裙摆自然垂坠",
+    "style": "法式复古",
+    "color_palette": ["米白", "浅蓝", "墨绿"],
+    "material": "雪纺",
+    "target_audience": "职场新人、约会出行的年轻女性",
+}
+
+COPY_TEXT = "宝子们！这条法式碎花裙真的太出片了～收腰设计超显瘦，雪纺面料轻盈透气，夏天穿又仙又舒服，约会通勤都能穿！"
+
+
+@dataclass
+class MockSettings:
+    vision_latency: float = 1.5       # 视觉请求首 token 前的等待 (秒)
+    text_latency: float = 0.3         # 文本请求首 token 前的等待 (秒)
+    embedding_latency: float = 0.1    # Embedding 请求耗时 (秒)
+    tokens_per_sec: float = 50.0      # 输出 token 速率
+    embedding_dim: int = 1536         # 与 text-embedding-v1 维度一致
+    # 故障注入，用于验证超时 / 重试 / 熔断 / 降级
+    error_rate: float = 0.0           # 按比例随机返回 503
+    slow_rate: float = 0.0            # 按比例额外等待 slow_latency 秒 (模拟长尾)
+    slow_latency: float = 10.0
+    failing_models: tuple = ()        # 这些模型的请求全部返回 503
+
+
+def fake_embedding(text: str, dim: int):
+    """基于文本哈希生成确定性的单位向量"""
+    values = []
+    seed = text.encode("utf-8")
+    while len(values) < dim:
+        seed = hashlib.sha256(seed).digest()
+        values.extend((b - 127.5) / 127.5 for b in seed)
+    values = values[:dim]
+    norm = sum(v * v for v in values) ** 0.5 or 1.0
+    return [v / norm for v in values]
+
+
+def make_handler(settings: MockSettings):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def _send_json(self, payload, status=200):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            payload = self._read_json()
+            if payload.get("model") in settings.failing_models or random.random() < settings.error_rate:
+                self._send_json({"error": {"message": "mock upstream unavailable", "type": "server_error"}}, status=503)
+                return
+            if random.random() < settings.slow_rate:
+                time.sleep(settings.slow_latency)
+            if self.path.endswith("/chat/completions"):
+                self._chat(payload)
+            elif self.path.endswith("/embeddings"):
+                self._embeddings(payload)
+            else:
+                self._send_json({"error": {"message": f"unknown path {self.path}"}}, status=404)
+
+        def _embeddings(self, payload):
+            inputs = payload.get("input", [])
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            time.sleep(settings.embedding_latency)
+            data = [
+                {"object": "embedding", "index": i, "embedding": fake_embedding(str(text), settings.embedding_dim)}
+                for i, text in enumerate(inputs)
+            ]
+            tokens = sum(len(str(text)) for text in inputs)
+            self._send_json({
+                "object": "list",
+                "data": data,
+                "model": payload.get("model"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            })
+
+        def _chat(self, payload):
+            messages = payload.get("messages", [])
+            is_vision = any(
+                isinstance(m.get("content"), list)
+                and any(part.get("type") == "image_url" for part in m["content"])
+                for m in messages
+            )
+            prompt_chars = sum(len(json.dumps(m.get("content"), ensure_ascii=False)) for m in messages)
+            text = json.dumps(VISION_RESULT, ensure_ascii=False) if is_vision else COPY_TEXT
+            # 用字符近似 token，按 max_tokens 截断
+            text = text[: payload.get("max_tokens") or len(text)]
+            usage = {
+                "prompt_tokens": prompt_chars // 2,
+                "completion_tokens": len(text),
+                "total_tokens": prompt_chars // 2 + len(text),
+            }
+            latency = settings.vision_latency if is_vision else settings.text_latency
+            time.sleep(latency)
+
+            completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+            model = payload.get("model")
+            if not payload.get("stream"):
+                time.sleep(len(text) / settings.tokens_per_sec)
+                self._send_json({
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                    "usage": usage,
+                })
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+
+            def send_chunk(delta, finish_reason=None, chunk_usage=None):
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if delta is not None else [],
+                }
+                if chunk_usage:
+                    chunk["usage"] = chunk_usage
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+            send_chunk({"role": "assistant", "content": ""})
+            for char in text:
+                time.sleep(1 / settings.tokens_per_sec)
+                send_chunk({"content": char})
+            send_chunk({}, finish_reason="stop")
+            if (payload.get("stream_options") or {}).get("include_usage"):
+                send_chunk(None, chunk_usage=usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.close_connection = True
+
+    return Handler
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    # 默认 listen backlog 只有 5，压测上百个并发连接时会被丢弃并触发 TCP 重传
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # 客户端超时断开 / 对冲请求被取消属于预期情况，不打印堆栈
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def start_mock_server(settings: MockSettings = None, host: str = "127.0.0.1", port: int = 0):
+    """在后台线程启动模拟服务，返回 (server, base_url)；port=0 时自动分配端口"""
+    settings = settings or MockSettings()
+    server = MockHTTPServer((host, port), make_handler(settings))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟 OpenAI 兼容服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--vision-latency", type=float, default=MockSettings.vision_latency)
+    parser.add_argument("--text-latency", type=float, default=MockSettings.text_latency)
+    parser.add_argument("--embedding-latency", type=float, default=MockSettings.embedding_latency)
+    parser.add_argument("--tokens-per-sec", type=float, default=MockSettings.tokens_per_sec)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="随机返回 503 的比例")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="额外等待 --slow-latency 秒的请求比例")
+    parser.add_argument("--slow-latency", type=float, default=MockSettings.slow_latency)
+    parser.add_argument("--failing-models", nargs="*", default=[], help="请求全部返回 503 的模型")
+    args = parser.parse_args()
+
+    settings = MockSettings(
+        vision_latency=args.vision_latency,
+        text_latency=args.text_latency,
+        embedding_latency=args.embedding_latency,
+        tokens_per_sec=args.tokens_per_sec,
+        error_rate=args.error_rate,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency,
+        failing_models=tuple(args.failing_models),
+    )
+    server, base_url = start_mock_server(settings, args.host, args.port)
+    print(f"模拟服务已启动: {base_url}  (Ctrl+C 退出)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
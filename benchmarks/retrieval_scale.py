@@ -0,0 +1,129 @@
+"""
+大规模语料下的语义检索耗时基准 (不含 Embedding 调用)。
+
+构造 N 条带 style 标签的合成范例写入临时 Chroma 库，加载风格分区索引后，测量
+core.rag.search_examples 在 "style 硬过滤 + 向量召回 + BM25 重排 + MMR" 各组合下的延迟，
+同时报告索引加载耗时与向量占用的内存。默认同时测 1536 维 (默认远程 Embedding 模型) 与 384 维 (本地模型)：
+
+    python -m benchmarks.retrieval_scale --size 100000 --dim 1536 384 --budget-ms 50
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+os.environ.setdefault("DASHSCOPE_API_KEY", "mock-key")
+os.environ.setdefault("METRICS_LOG", "0")
+os.environ.setdefault("METRICS_SQLITE_PATH", "")
+
+from langchain_chroma import Chroma  # noqa: E402
+
+from core.rag import build_style_index, search_examples  # noqa: E402
+
+STYLES = ["小红书", "朋友圈", "京东电商", "淘宝电商", "抖音直播", "微博", "B站", "知乎"]
+PRODUCTS = ["连衣裙", "运动鞋", "风衣", "降噪耳机", "咖啡机", "防晒衣", "洁面乳", "红酒", "斗篷大衣", "休闲裤"]
+MATERIALS = ["纯棉", "真丝", "雪纺", "皮革", "牛仔", "羊毛", "不锈钢", "亚麻"]
+AUDIENCES = ["职场新人", "学生党", "宝妈", "户外爱好者", "精致白领", "送礼人群"]
+PHRASES = ["显瘦又显气质", "舒服到不想脱", "闭眼冲", "性价比超高", "细节满满", "高级感拉满", "通勤约会都合适"]
+
+
+def synthetic_text(rng: random.Random) -> str:
+    return (f"{rng.choice(PRODUCTS)}，{rng.choice(MATERIALS)}面料，适合{rng.choice(AUDIENCES)}，"
+            f"{rng.choice(PHRASES)}，{rng.choice(PHRASES)}")
+
+
+def build_store(path: str, size: int, dim: int, seed: int = 0):
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    store = Chroma(persist_directory=path, collection_metadata={"hnsw:space": "cosine"})
+    batch = 5000
+    for start in range(0, size, batch):
+        n = min(batch, size - start)
+        vectors = np_rng.standard_normal((n, dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        store._collection.add(
+            ids=[f"doc-{start + i}" for i in range(n)],
+            embeddings=vectors,
+            documents=[synthetic_text(rng) for _ in range(n)],
+            metadatas=[{"style": rng.choice(STYLES)} for _ in range(n)],
+        )
+    return store
+
+
+def measure(store, index, dim: int, queries: int, **options):
+    rng = random.Random(1)
+    np_rng = np.random.default_rng(1)
+    timings = []
+    for _ in range(queries):
+        vector = np_rng.standard_normal(dim).astype(np.float32)
+        vector /= np.linalg.norm(vector)
+        text = synthetic_text(rng)
+        label = rng.choice(STYLES)
+        start = time.perf_counter()
+        search_examples(vector.tolist(), text, [label], k=3, index=index, vector_store=store, **options)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "p50": statistics.median(timings),
+        "p95": timings[int(0.95 * (len(timings) - 1))],
+        "p99": timings[int(0.99 * (len(timings) - 1))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="语义检索规模基准")
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--dim", type=int, nargs="+", default=[1536, 384], help="向量维度，可填多个")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--fetch-k", type=int, default=20)
+    parser.add_argument("--budget-ms", type=float, default=50.0)
+    args = parser.parse_args()
+
+    failed = False
+    for dim in args.dim:
+        failed |= not run_dim(args, dim)
+    print(f"\n预算: p95 <= {args.budget_ms}ms —— {'通过' if not failed else '未通过'}")
+
+
+def run_dim(args, dim: int) -> bool:
+    """测一个维度，返回是否全部在预算内"""
+    workdir = tempfile.mkdtemp(prefix="ecommate_rag_scale_")
+    try:
+        print(f"\n===== dim={dim} =====")
+        start = time.perf_counter()
+        store = build_store(workdir, args.size, dim)
+        print(f"构建 {args.size} 条范例耗时 {time.perf_counter() - start:.1f}s")
+
+        start = time.perf_counter()
+        build_style_index(store)
+        print(f"加载风格索引 (仅文本，已知风格查表用) 耗时 {time.perf_counter() - start:.1f}s")
+        start = time.perf_counter()
+        index = build_style_index(store, with_vectors=True)
+        vector_mb = sum(partition["vectors"].nbytes for partition in index.values()) / 1024 / 1024
+        print(f"加载风格分区向量索引 (语义检索用) 耗时 {time.perf_counter() - start:.1f}s，向量占用 {vector_mb:.0f}MB")
+        measure(store, index, dim, 10, fetch_k=args.fetch_k, use_mmr=False, rerank="none")
+
+        variants = {
+            "向量召回": dict(use_mmr=False, rerank="none"),
+            "向量召回 + MMR": dict(use_mmr=True, rerank="none"),
+            "向量召回 + BM25 + MMR": dict(use_mmr=True, rerank="bm25"),
+        }
+        ok_all = True
+        print(f"{'方案':<24}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+        for name, options in variants.items():
+            r = measure(store, index, dim, args.queries, fetch_k=args.fetch_k, **options)
+            ok = r["p95"] <= args.budget_ms
+            ok_all &= ok
+            print(f"{name:<24}{r['p50']:>10.2f}{r['p95']:>10.2f}{r['p99']:>10.2f}  {'OK' if ok else 'OVER BUDGET'}")
+        return ok_all
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
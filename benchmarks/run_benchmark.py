@@ -0,0 +1,228 @@
+"""
+离线性能基准：在本地模拟服务上测量 core/ 各环节与整条工作流的耗时。
+
+    python -m benchmarks.run_benchmark --out bench_results.json
+    python -m benchmarks.run_benchmark --out new.json --compare bench_results.json
+
+默认自动启动 benchmarks.mock_server，也可用 --base-url 指向已启动的模拟服务。
+结果 JSON 包含 commit、各场景 p50/p95/p99、批量场景吞吐量与峰值 RSS，可跨提交对比。
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.mock_server import MockSettings, start_mock_server
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEMO_IMAGE = os.path.join(PROJECT_ROOT, "assets", "demo_image.jpg")
+
+
+def percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarize(timings, elapsed: float = None) -> dict:
+    summary = {
+        "n": len(timings),
+        "mean": round(statistics.mean(timings), 4),
+        "p50": round(percentile(timings, 50), 4),
+        "p95": round(percentile(timings, 95), 4),
+        "p99": round(percentile(timings, 99), 4),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if elapsed:
+        summary["throughput"] = round(len(timings) / elapsed, 3)
+    return summary
+
+
+def peak_rss_mb() -> float:
+    # Linux 下 ru_maxrss 单位为 KB，macOS 下为字节
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def timed_runs(func, repeat: int, before=None):
+    timings = []
+    for _ in range(repeat):
+        if before:
+            before()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def make_catalog(directory: str, count: int):
+    """生成 count 张内容各不相同的图片，避免批量场景命中视觉缓存"""
+    from PIL import Image
+
+    os.makedirs(directory, exist_ok=True)
+    base = Image.open(DEMO_IMAGE).convert("RGB")
+    for i in range(count):
+        image = base.copy()
+        image.putpixel((i % image.width, i // image.width), (i % 256, 255 - i % 256, 128))
+        image.save(os.path.join(directory, f"sku_{i:04d}.jpg"), quality=90)
+
+
+def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="ecommate_bench_")
+    if args.base_url:
+        base_url = args.base_url
+    else:
+        settings = MockSettings(
+            vision_latency=args.vision_latency,
+            text_latency=args.text_latency,
+            embedding_latency=args.embedding_latency,
+            tokens_per_sec=args.tokens_per_sec,
+        )
+        _, base_url = start_mock_server(settings)
+
+    # config 在导入时读取环境变量，必须先设置好再导入 core
+    os.environ["LLM_BASE_URL"] = base_url
+    os.environ.setdefault("DASHSCOPE_API_KEY", "mock-key")
+    os.environ["CACHE_DIR"] = os.path.join(workdir, "cache")
+    os.environ["METRICS_LOG"] = "0"
+    # 感知哈希去重会让重复的测试图片跳过视觉模型，基准默认关闭，测量完整调用链路
+    os.environ.setdefault("PHASH_INDEX", "0")
+    os.environ["METRICS_SQLITE_PATH"] = ""
+
+    import config
+    # 在副本上跑，避免改动仓库里的向量库
+    db_copy = os.path.join(workdir, "chroma_db")
+    shutil.copytree(config.VECTOR_DB_DIR, db_copy)
+    config.VECTOR_DB_DIR = db_copy
+
+    from core.bulk import iter_directory_jobs, run_bulk
+    from core.rag import retrieve_examples, warmup_rag
+    from core.vision import analyze_image, get_vision_cache
+    from core.workflow import generate_node, get_workflow
+
+    warmup_rag()
+    image_bytes = open(DEMO_IMAGE, "rb").read()
+    clear_vision_cache = get_vision_cache().clear
+    image_data = analyze_image(image_bytes)
+    examples = retrieve_examples("小红书种草")
+    inputs = {
+        "image_path": DEMO_IMAGE,
+        "user_style": "小红书种草",
+        "words_limit": "100",
+        "user_note": "",
+        "image_data": {},
+        "retrieved_examples": [],
+        "final_copy": "",
+    }
+
+    results = {}
+    print("场景: analyze_image")
+    results["analyze_image"] = summarize(timed_runs(lambda: analyze_image(image_bytes), args.repeat, clear_vision_cache))
+    print("场景: analyze_image (缓存命中)")
+    results["analyze_image_cached"] = summarize(timed_runs(lambda: analyze_image(image_bytes), args.repeat))
+    print("场景: retrieve_examples")
+    results["retrieve_examples"] = summarize(timed_runs(lambda: retrieve_examples("小红书种草"), args.repeat))
+    print("场景: retrieve_examples (自由文本风格)")
+    results["retrieve_examples_free_text"] = summarize(
+        timed_runs(lambda: retrieve_examples("温柔知性的穿搭分享"), args.repeat)
+    )
+    print("场景: generate_node")
+    generate_state = {**inputs, "image_data": image_data, "retrieved_examples": examples}
+    results["generate_node"] = summarize(timed_runs(lambda: generate_node(generate_state), args.repeat))
+    print("场景: workflow.invoke")
+    app = get_workflow()
+    results["workflow_invoke"] = summarize(timed_runs(lambda: app.invoke(dict(inputs)), args.repeat, clear_vision_cache))
+
+    catalog_dir = os.path.join(workdir, "catalog")
+    make_catalog(catalog_dir, args.bulk_size)
+    for concurrency in args.concurrency:
+        print(f"场景: bulk (并发 {concurrency})")
+        clear_vision_cache()
+        out_path = os.path.join(workdir, f"bulk_{concurrency}.jsonl")
+        jobs = iter_directory_jobs(catalog_dir, ["小红书种草"], "100", "")
+        start = time.perf_counter()
+        asyncio.run(run_bulk(jobs, out_path, concurrency=concurrency, max_retries=0))
+        elapsed = time.perf_counter() - start
+        with open(out_path, encoding="utf-8") as f:
+            latencies = [r["latency"] for r in map(json.loads, f) if r["status"] == "ok"]
+        if latencies:
+            results[f"bulk_c{concurrency}"] = summarize(latencies, elapsed)
+
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "base_url": base_url if args.base_url else "mock",
+        "settings": {
+            "repeat": args.repeat,
+            "bulk_size": args.bulk_size,
+            "vision_latency": args.vision_latency,
+            "text_latency": args.text_latency,
+            "embedding_latency": args.embedding_latency,
+            "tokens_per_sec": args.tokens_per_sec,
+        },
+        "peak_rss_mb": peak_rss_mb(),
+        "results": results,
+    }
+
+
+def print_report(report: dict, baseline: dict = None):
+    print(f"\n========== 基准结果 (commit {report['commit']}) ==========")
+    header = f"{'场景':<30}{'p50':>9}{'p95':>9}{'p99':>9}{'吞吐/s':>9}"
+    if baseline:
+        header += f"{'p50 变化':>12}"
+    print(header)
+    for name, r in report["results"].items():
+        line = f"{name:<30}{r['p50']:>9.3f}{r['p95']:>9.3f}{r['p99']:>9.3f}{r.get('throughput', 0):>9.2f}"
+        old = (baseline or {}).get("results", {}).get(name)
+        if old:
+            change = (r["p50"] - old["p50"]) / old["p50"] * 100 if old["p50"] else 0.0
+            line += f"{change:>+11.1f}%"
+        print(line)
+    print(f"峰值 RSS: {report['peak_rss_mb']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="E-ComMate 离线性能基准")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", help="与之前的结果 JSON 对比")
+    parser.add_argument("--base-url", help="使用已启动的模拟服务，而不是自动启动")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--bulk-size", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--vision-latency", type=float, default=MockSettings.vision_latency)
+    parser.add_argument("--text-latency", type=float, default=MockSettings.text_latency)
+    parser.add_argument("--embedding-latency", type=float, default=MockSettings.embedding_latency)
+    parser.add_argument("--tokens-per-sec", type=float, default=MockSettings.tokens_per_sec)
+    args = parser.parse_args()
+
+    report = run(args)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print(f"结果已写入 {args.out}")
+
+
+if __name__ == "__main__":
+    main()
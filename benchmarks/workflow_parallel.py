@@ -0,0 +1,89 @@
+"""
+串行 vs 并行工作流耗时对比。
+
+默认使用模拟耗时（不消耗 API 额度）：
+    python -m benchmarks.workflow_parallel --vision 3.0 --retrieve 0.8 --generate 2.0
+
+使用真实模型（需要 .env 中的 API Key）：
+    python -m benchmarks.workflow_parallel --live --image assets/demo_image.jpg
+"""
+import argparse
+import statistics
+import time
+
+from langchain_core.messages import AIMessageChunk
+
+import core.workflow as workflow
+
+
+def patch_simulated(vision_s: float, retrieve_s: float, generate_s: float):
+    """把外部调用替换成固定耗时的桩函数，只测量图编排本身带来的差异"""
+
+    def fake_analyze_image(image_path):
+        time.sleep(vision_s)
+        return {"description": "模拟商品", "style": "简约", "color_palette": [], "material": "纯棉", "target_audience": "学生"}
+
+    def fake_retrieve_examples(style, k=3, **kwargs):
+        time.sleep(retrieve_s)
+        return ["模拟范例"] * k
+
+    class FakeLLM:
+        def stream(self, prompt, **kwargs):
+            time.sleep(generate_s)
+            yield AIMessageChunk(content="模拟文案")
+
+    workflow.analyze_image = fake_analyze_image
+    workflow.retrieve_examples = fake_retrieve_examples
+    workflow.get_llm = lambda model=None: FakeLLM()
+
+
+def run(app, inputs, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        app.invoke(dict(inputs))
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="串行 vs 并行工作流耗时对比")
+    parser.add_argument("--live", action="store_true", help="调用真实模型，而不是模拟耗时")
+    parser.add_argument("--image", default="assets/demo_image.jpg")
+    parser.add_argument("--style", default="小红书种草")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--vision", type=float, default=3.0, help="模拟视觉解析耗时 (秒)")
+    parser.add_argument("--retrieve", type=float, default=0.8, help="模拟检索耗时 (秒)")
+    parser.add_argument("--generate", type=float, default=2.0, help="模拟生成耗时 (秒)")
+    args = parser.parse_args()
+
+    if not args.live:
+        patch_simulated(args.vision, args.retrieve, args.generate)
+
+    inputs = {
+        "image_path": args.image,
+        "user_style": args.style,
+        "words_limit": "100",
+        "user_note": "",
+        "image_data": {},
+        "retrieved_examples": [],
+        "final_copy": "",
+    }
+
+    results = {}
+    for name, parallel in (("serial", False), ("parallel", True)):
+        app = workflow.create_workflow(parallel=parallel)
+        results[name] = run(app, inputs, args.repeat)
+
+    print("\n========== 工作流耗时对比 ==========")
+    for name, timings in results.items():
+        print(f"{name:<10} mean={statistics.mean(timings):.3f}s  min={min(timings):.3f}s  max={max(timings):.3f}s")
+    speedup = statistics.mean(results["serial"]) / statistics.mean(results["parallel"])
+    print(f"加速比: {speedup:.2f}x")
+    if not args.live:
+        expected = max(args.vision, args.retrieve) + args.generate
+        print(f"理论并行耗时: {expected:.3f}s (max(vision, retrieve) + generate)")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,123 @@ VISION_MODEL_NAME = os.getenv("VISION_MODEL_NAME", "qwen-vl-max")
 EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "text-embedding-v1")
 
 VECTOR_DB_DIR = os.path.join(os.path.dirname(__file__), "data", "chroma_db")
+# 风格范例语料，按项目根目录定位，不依赖启动时的工作目录
+STYLES_CSV_PATH = os.getenv("STYLES_CSV_PATH", os.path.join(os.path.dirname(__file__), "data", "styles.csv"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 25))  # 单次 Embedding 请求的文本条数
 
-if not API_KEY:
-    raise ValueError("未检测到 API Key，请检查 .env 文件！")
\ No newline at end of file
+# Embedding 后端：dashscope (远程接口) / local (CPU 本地模型，需 pip install sentence-transformers)。
+# 不同后端的向量写入各自的 collection，切换后会自动重建索引，不会混用向量空间
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "dashscope")
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "BAAI/bge-small-zh-v1.5")
+LOCAL_EMBEDDING_RUNTIME = os.getenv("LOCAL_EMBEDDING_RUNTIME", "torch")  # torch / onnx
+LOCAL_EMBEDDING_DEVICE = os.getenv("LOCAL_EMBEDDING_DEVICE", "cpu")
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", 32))
+
+# 语义检索：风格作为硬过滤，用视觉解析出的商品属性做查询。开启后检索需等待视觉结果，
+# 语料较小 (每种风格只有几条) 时风格索引已足够，语料扩大后建议开启
+RAG_SEMANTIC_RETRIEVAL = os.getenv("RAG_SEMANTIC_RETRIEVAL", "0") == "1"
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", 3))
+RAG_FETCH_K = int(os.getenv("RAG_FETCH_K", 20))  # 进入重排 / MMR 的候选数
+RAG_MMR = os.getenv("RAG_MMR", "1") == "1"
+RAG_MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", 0.5))  # 1 只看相关性，0 只看多样性
+RAG_RERANK = os.getenv("RAG_RERANK", "bm25")  # bm25 / none
+
+# 本地缓存目录 (视觉解析结果等)
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(os.path.dirname(__file__), "data", "cache"))
+VISION_CACHE_TTL = float(os.getenv("VISION_CACHE_TTL", 7 * 24 * 3600))  # 秒，0 表示不过期
+VISION_CACHE_MAX_ENTRIES = int(os.getenv("VISION_CACHE_MAX_ENTRIES", 5000))
+# 感知哈希 (dHash) 近似去重：重拍、裁剪、重新压缩的同款商品图复用已有的视觉解析结果，设为 0 关闭。
+# PHASH_MAX_DISTANCE 为 64 位哈希允许的 Hamming 距离 (不超过 7 时查询最快)，PHASH_MAX_COLOR_DELTA 为平均颜色允许的差值 (0-255)
+PHASH_INDEX = os.getenv("PHASH_INDEX", "1") == "1"
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", 6))
+PHASH_MAX_COLOR_DELTA = int(os.getenv("PHASH_MAX_COLOR_DELTA", 24))
+
+# 文案生成 Prompt：参考范例的 token 预算、单条范例至少保留的 token 数、计数用的 tiktoken 编码
+# (留空或加载失败时按字符数估算)；输出上限按 字数 x GENERATION_TOKENS_PER_WORD 推算
+PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", "cl100k_base")
+# 服务启动时等待 tokenizer 词表加载 (首次需下载) 的最长秒数，超时后先按字符数估算，加载完成后自动切换
+PROMPT_TOKENIZER_TIMEOUT = float(os.getenv("PROMPT_TOKENIZER_TIMEOUT", 5))
+PROMPT_EXAMPLE_TOKEN_BUDGET = int(os.getenv("PROMPT_EXAMPLE_TOKEN_BUDGET", 450))
+PROMPT_MIN_EXAMPLE_TOKENS = int(os.getenv("PROMPT_MIN_EXAMPLE_TOKENS", 40))
+GENERATION_MAX_TOKENS = int(os.getenv("GENERATION_MAX_TOKENS", 2048))
+GENERATION_TOKENS_PER_WORD = float(os.getenv("GENERATION_TOKENS_PER_WORD", 1.5))
+
+# 文案生成结果缓存 (图片哈希 + 全部输入 + 模型 / Prompt 版本)，相同请求直接返回，设为 0 关闭
+GENERATION_CACHE = os.getenv("GENERATION_CACHE", "1") == "1"
+GENERATION_CACHE_TTL = float(os.getenv("GENERATION_CACHE_TTL", 24 * 3600))  # 秒，0 表示不过期
+GENERATION_CACHE_MAX_ENTRIES = int(os.getenv("GENERATION_CACHE_MAX_ENTRIES", 2000))
+# Embedding 持久化缓存 (按 模型 + 文本哈希)，重复的查询与入库文本不再重新计算，设为空字符串关闭
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(CACHE_DIR, "embeddings.sqlite3"))
+
+# 视觉模型调用前的图片预处理：限制最长边、去除 EXIF、重新编码
+VISION_MAX_EDGE = int(os.getenv("VISION_MAX_EDGE", 1280))
+VISION_IMAGE_FORMAT = os.getenv("VISION_IMAGE_FORMAT", "JPEG")  # JPEG / WEBP
+VISION_IMAGE_QUALITY = int(os.getenv("VISION_IMAGE_QUALITY", 85))
+
+# 上传图片只保存在进程内存中 (按内容哈希寻址，超出总量时淘汰最久未用的)；
+# 聊天记录里只保留缩略图，每个会话的缩略图总量有上限
+BLOB_STORE_MAX_BYTES = int(os.getenv("BLOB_STORE_MAX_BYTES", 256 * 1024 * 1024))
+THUMBNAIL_MAX_EDGE = int(os.getenv("THUMBNAIL_MAX_EDGE", 320))
+SESSION_IMAGE_MAX_BYTES = int(os.getenv("SESSION_IMAGE_MAX_BYTES", 2 * 1024 * 1024))
+
+# 性能埋点：结构化日志 (默认关闭，每个阶段打印一行 JSON) / SQLite 落盘 / Prometheus 文本端点 (端口为 0 时不启动)
+METRICS_LOG = os.getenv("METRICS_LOG", "0") == "1"
+METRICS_SQLITE_PATH = os.getenv("METRICS_SQLITE_PATH", os.path.join(CACHE_DIR, "metrics.sqlite3"))
+# SQLite 落盘由后台线程批量写入：队列上限 (满了丢弃并计数)、每批最多条数、攒批的最长秒数
+METRICS_QUEUE_SIZE = int(os.getenv("METRICS_QUEUE_SIZE", 10000))
+METRICS_BATCH_SIZE = int(os.getenv("METRICS_BATCH_SIZE", 500))
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 1.0))
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+# 进程内共享的 HTTP 连接池 (所有模型客户端复用 keep-alive 连接)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 20))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 10))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60))
+# 异步调用 (ainvoke / astream) 的连接上限，单进程服务大量并发生成时调大
+HTTP_ASYNC_MAX_CONNECTIONS = int(os.getenv("HTTP_ASYNC_MAX_CONNECTIONS", 200))
+
+# 批量生成 (一图多风格) 时同时进行的文案生成请求数上限
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 4))
+
+# 按模型的令牌桶限流 (请求数/秒)，0 表示不限流；批量跑商品目录时按 API 配额设置
+TEXT_LLM_RPS = float(os.getenv("TEXT_LLM_RPS", 0))
+VISION_LLM_RPS = float(os.getenv("VISION_LLM_RPS", 0))
+
+# 上游模型调用的容错 (core/resilience.py)
+# 单次请求超时 (秒)，按模型分别设置；超时、连接错误、429、5xx 按带抖动的指数退避重试，
+# 一次调用 (含重试与降级) 总耗时不超过 UPSTREAM_DEADLINE
+TEXT_LLM_TIMEOUT = float(os.getenv("TEXT_LLM_TIMEOUT", 60))
+VISION_LLM_TIMEOUT = float(os.getenv("VISION_LLM_TIMEOUT", 45))
+EMBEDDING_TIMEOUT = float(os.getenv("EMBEDDING_TIMEOUT", 20))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", 2))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", 0.5))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", 8))
+UPSTREAM_DEADLINE = float(os.getenv("UPSTREAM_DEADLINE", 120))
+# 熔断：同一模型连续失败 N 次后熔断，CIRCUIT_RESET_TIMEOUT 秒后放行一个探测请求
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", 30))
+# 降级模型 (逗号分隔，按顺序尝试)，主模型重试用尽或熔断时使用；留空表示不降级
+TEXT_LLM_FALLBACKS = [m.strip() for m in os.getenv("TEXT_LLM_FALLBACKS", "qwen-turbo").split(",") if m.strip()]
+VISION_LLM_FALLBACKS = [m.strip() for m in os.getenv("VISION_LLM_FALLBACKS", "qwen-vl-plus").split(",") if m.strip()]
+# 视觉请求对冲：超过最近 p95 耗时 (或填固定秒数) 仍未返回时再发一个相同请求，取先返回的；0 关闭
+VISION_HEDGE_AFTER = os.getenv("VISION_HEDGE_AFTER", "p95")
+VISION_HEDGE_MIN_DELAY = float(os.getenv("VISION_HEDGE_MIN_DELAY", 2.0))
+# 对冲请求最多占视觉请求的比例；熔断器不是 closed 时不对冲。HEDGE_MAX_WORKERS 为同时进行的对冲请求上限
+VISION_HEDGE_MAX_RATIO = float(os.getenv("VISION_HEDGE_MAX_RATIO", 0.1))
+HEDGE_MAX_WORKERS = int(os.getenv("HEDGE_MAX_WORKERS", 16))
+
+# HTTP API 服务 (api.py)：后台任务的 worker 数、排队上限 (满了返回 429)、每个调用方同时进行的请求数
+API_WORKERS = int(os.getenv("API_WORKERS", 8))
+API_QUEUE_SIZE = int(os.getenv("API_QUEUE_SIZE", 100))
+API_CLIENT_MAX_CONCURRENCY = int(os.getenv("API_CLIENT_MAX_CONCURRENCY", 4))
+API_JOB_TTL = float(os.getenv("API_JOB_TTL", 3600))  # 已完成任务的结果保留时长 (秒)
+API_MAX_IMAGE_BYTES = int(os.getenv("API_MAX_IMAGE_BYTES", 10 * 1024 * 1024))
+
+def require_api_key() -> str:
+    """
+    首次创建模型客户端时才校验 API Key，而不是在 import 时：
+    没有 Key 的环境 (工具脚本、启动耗时基准、只用本地 Embedding 的流程) 也能导入本项目。
+    """
+    if not API_KEY:
+        raise ValueError("未检测到 API Key，请检查 .env 文件！")
+    return API_KEY
\ No newline at end of file
@@ -0,0 +1,69 @@
+import threading
+from collections import OrderedDict
+
+import config
+from core.cache import hash_bytes
+
+
+class BlobStore:
+    """
+    进程内按内容寻址的图片存储：引用即图片的 sha256，同一张图只存一份。
+    总字节数超过上限时淘汰最久未访问的图片，不落盘。
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._blobs = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def put(self, data: bytes) -> str:
+        ref = hash_bytes(data)
+        with self._lock:
+            if ref in self._blobs:
+                self._blobs.move_to_end(ref)
+                return ref
+            self._blobs[ref] = data
+            self._size += len(data)
+            # 至少保留刚放入的这一张
+            while self._size > self.max_bytes and len(self._blobs) > 1:
+                _, evicted = self._blobs.popitem(last=False)
+                self._size -= len(evicted)
+        return ref
+
+    def get(self, ref: str) -> bytes:
+        with self._lock:
+            data = self._blobs.get(ref)
+            if data is None:
+                raise KeyError(f"图片已过期或不存在: {ref[:12]}")
+            self._blobs.move_to_end(ref)
+            return data
+
+    def __contains__(self, ref: str) -> bool:
+        with self._lock:
+            return ref in self._blobs
+
+    def size(self) -> int:
+        return self._size
+
+
+_blob_store = None
+_blob_store_lock = threading.Lock()
+
+
+def get_blob_store() -> BlobStore:
+    global _blob_store
+    if _blob_store is None:
+        with _blob_store_lock:
+            if _blob_store is None:
+                _blob_store = BlobStore(config.BLOB_STORE_MAX_BYTES)
+    return _blob_store
+
+
+def put_image(data: bytes) -> str:
+    """存入图片，返回内容哈希引用 (可放进 AgentState.image_ref)"""
+    return get_blob_store().put(data)
+
+
+def get_image(ref: str) -> bytes:
+    return get_blob_store().get(ref)
@@ -0,0 +1,219 @@
+"""
+无界面的商品目录批量生成：
+    python -m core.bulk --images-dir ./catalog --styles 小红书种草 京东/淘宝电商 --out results.jsonl
+    python -m core.bulk --manifest manifest.csv --out results.jsonl --concurrency 16
+
+manifest.csv 列：image_path, user_style, words_limit, user_note, sku (后三列可选)。
+结果文件为追加写入的 JSONL，同时充当断点：重新运行时已成功的任务会被跳过。
+模型级限流见 config.TEXT_LLM_RPS / config.VISION_LLM_RPS。
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import time
+from typing import Dict, Iterator
+
+from core.cache import hash_bytes
+from core.workflow import get_workflow
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+class VisionFailedError(RuntimeError):
+    """视觉节点返回了兜底结果，任务级唯一会重试的失败"""
+
+
+def job_id(job: Dict) -> str:
+    """
+    任务 id：图片路径 + 图片内容哈希 + 风格 + 字数 + 备注。sku 只是文件名或清单里的标签，
+    a.jpg / a.png 或同一 sku 对应不同图片时会撞 id，断点续跑会误跳过，因此不用 sku；
+    内容哈希保证图片被替换后会重新生成。
+    """
+    try:
+        with open(job["image_path"], "rb") as f:
+            image = hash_bytes(f.read())
+    except OSError:
+        # 图片读不到时任务本身会失败并记为 error
+        image = ""
+    return hash_bytes(job["image_path"], image, job["user_style"], job["words_limit"], job["user_note"])[:16]
+
+
+def iter_directory_jobs(images_dir: str, styles, words_limit: str, user_note: str) -> Iterator[Dict]:
+    for name in sorted(os.listdir(images_dir)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        image_path = os.path.join(images_dir, name)
+        for style in styles:
+            yield {
+                "sku": os.path.splitext(name)[0],
+                "image_path": image_path,
+                "user_style": style,
+                "words_limit": words_limit,
+                "user_note": user_note,
+            }
+
+
+def iter_manifest_jobs(manifest_path: str, words_limit: str, user_note: str) -> Iterator[Dict]:
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, newline="", encoding="utf-8-sig") as f:
+        for row in csv.DictReader(f):
+            image_path = row["image_path"]
+            if not os.path.isabs(image_path):
+                image_path = os.path.join(base_dir, image_path)
+            yield {
+                "sku": row.get("sku") or row["image_path"],
+                "image_path": image_path,
+                "user_style": row["user_style"],
+                "words_limit": row.get("words_limit") or words_limit,
+                "user_note": row.get("user_note") or user_note,
+            }
+
+
+def load_finished(out_path: str) -> set:
+    """读取已有结果文件，返回已成功完成的任务 id (断点续跑)"""
+    finished = set()
+    if not os.path.exists(out_path):
+        return finished
+    with open(out_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 中断时可能留下半行，忽略即可
+                continue
+            if record.get("status") == "ok":
+                finished.add(record["job_id"])
+    return finished
+
+
+async def generate_job(app, inputs: Dict) -> Dict:
+    """
+    通过工作流 (astream) 跑一个任务，返回最终 State。
+    视觉节点一结束就检查结果：解析失败时立即停止工作流并抛出 VisionFailedError，
+    不为占位属性白白调用一次文案生成。
+    """
+    final_state = None
+    stream = app.astream(inputs, stream_mode=["updates", "values"])
+    try:
+        async for mode, chunk in stream:
+            if mode == "updates":
+                vision = chunk.get("vision_step") or {}
+                if vision.get("vision_failed"):
+                    raise VisionFailedError(vision["image_data"].get("error") or "视觉解析失败")
+            else:
+                final_state = chunk
+    finally:
+        # 提前退出时关闭流，取消尚未开始的节点
+        await stream.aclose()
+    return final_state
+
+
+async def run_job(app, job: Dict, max_retries: int, backoff: float) -> Dict:
+    inputs = {
+        "image_path": job["image_path"],
+        "user_style": job["user_style"],
+        "words_limit": str(job["words_limit"]),
+        "user_note": job["user_note"],
+        "image_data": {},
+        "retrieved_examples": [],
+        "final_copy": "",
+    }
+    for attempt in range(max_retries + 1):
+        start = time.perf_counter()
+        try:
+            res = await generate_job(app, inputs)
+            return {
+                "status": "ok",
+                "final_copy": res["final_copy"],
+                "image_data": res["image_data"],
+                "degraded": bool(res.get("degraded")),
+                "attempts": attempt + 1,
+                "latency": round(time.perf_counter() - start, 3),
+            }
+        except Exception as e:
+            # 单次模型调用的重试与降级已由 core.resilience 完成，这里不再叠加重试；
+            # 只有视觉解析失败 (视觉节点吞掉了异常) 时隔一段时间整体再试，给熔断器恢复的时间
+            if attempt == max_retries or not isinstance(e, VisionFailedError):
+                return {"status": "error", "error": str(e), "attempts": attempt + 1}
+            # 指数退避 + 随机抖动，避免大量任务同时重试
+            delay = backoff * (2 ** attempt) * (0.5 + random.random())
+            print(f"[{job['sku']}/{job['user_style']}] 第 {attempt + 1} 次失败: {e}，{delay:.1f}s 后重试")
+            await asyncio.sleep(delay)
+
+
+async def run_bulk(jobs: Iterator[Dict], out_path: str, concurrency: int = 8,
+                   max_retries: int = 1, backoff: float = 5.0) -> Dict:
+    """
+    以最多 concurrency 个并发请求跑完 jobs，结果逐行追加到 out_path。
+    jobs 是惰性迭代器，任务队列有上限，不会一次性把整个目录读进内存。
+    """
+    app = get_workflow()
+    finished = load_finished(out_path)
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    write_lock = asyncio.Lock()
+    stats = {"ok": 0, "error": 0, "skipped": 0}
+
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    os.makedirs(out_dir, exist_ok=True)
+
+    with open(out_path, "a", encoding="utf-8") as out:
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    queue.task_done()
+                    return
+                jid, job = item
+                result = await run_job(app, job, max_retries, backoff)
+                record = {"job_id": jid, **job, **result}
+                async with write_lock:
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    out.flush()
+                stats[result["status"]] += 1
+                queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        for job in jobs:
+            jid = job_id(job)
+            if jid in finished:
+                stats["skipped"] += 1
+                continue
+            await queue.put((jid, job))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="E-ComMate 商品目录批量文案生成")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--images-dir", help="商品图片目录")
+    source.add_argument("--manifest", help="CSV 清单 (image_path, user_style, words_limit, user_note, sku)")
+    parser.add_argument("--styles", nargs="+", default=["小红书种草"], help="目录模式下每张图生成的风格")
+    parser.add_argument("--words-limit", default="100")
+    parser.add_argument("--note", default="")
+    parser.add_argument("--out", default="bulk_results.jsonl", help="结果 JSONL (兼作断点文件)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max-retries", type=int, default=1, help="视觉解析失败时任务整体重试的次数")
+    parser.add_argument("--backoff", type=float, default=5.0, help="首次重试等待秒数")
+    args = parser.parse_args()
+
+    if args.images_dir:
+        jobs = iter_directory_jobs(args.images_dir, args.styles, args.words_limit, args.note)
+    else:
+        jobs = iter_manifest_jobs(args.manifest, args.words_limit, args.note)
+
+    start = time.perf_counter()
+    stats = asyncio.run(run_bulk(jobs, args.out, args.concurrency, args.max_retries, args.backoff))
+    elapsed = time.perf_counter() - start
+    print(f"\n完成：成功 {stats['ok']}，失败 {stats['error']}，跳过 {stats['skipped']}，耗时 {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
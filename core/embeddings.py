@@ -0,0 +1,160 @@
+import os
+import re
+import sqlite3
+import threading
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+import config
+from core.cache import hash_bytes
+from core.metrics import span
+from core.resilience import acall_upstream, call_upstream
+
+
+def embedding_model_id() -> str:
+    """当前 Embedding 后端 + 模型的唯一标识，向量空间不同则标识不同"""
+    if config.EMBEDDING_BACKEND == "local":
+        return f"local:{config.LOCAL_EMBEDDING_MODEL}"
+    return f"dashscope:{config.EMBEDDING_MODEL_NAME}"
+
+
+def collection_name() -> str:
+    """
+    按 Embedding 模型区分 Chroma collection，切换后端会写入新的 collection 并重新建索引，
+    不会把两个向量空间的向量混在一起。
+    默认的远程 text-embedding-v1 沿用历史的 "langchain" collection 名。注意旧版本写入的行以随机 UUID 为 id，
+    首次 sync_index 会删除这些行并按内容哈希 id 重新 Embedding 整个 styles.csv (一次性的全量重建)。
+    """
+    if embedding_model_id() == "dashscope:text-embedding-v1":
+        return "langchain"
+    slug = re.sub(r"[^a-zA-Z0-9]+", "_", embedding_model_id()).strip("_").lower()
+    # Chroma 要求名称长度 3~63
+    return f"styles_{slug}"[:63]
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    CPU 本地 Embedding (sentence-transformers，可选 ONNX 运行时)，模型在进程内只加载一次。
+    需要额外安装：pip install sentence-transformers
+    """
+
+    def __init__(self, model_name: str, device: str = "cpu", batch_size: int = 32, runtime: str = "torch"):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError(
+                "EMBEDDING_BACKEND=local 需要安装 sentence-transformers：pip install sentence-transformers"
+            ) from e
+        print(f"正在加载本地 Embedding 模型: {model_name} ({runtime}/{device}) ...")
+        self.model = SentenceTransformer(model_name, device=device, backend=runtime)
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.model.encode(
+            list(texts),
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        return vectors.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class ResilientEmbeddings(Embeddings):
+    """远程 Embedding 接口外包一层重试与熔断 (core.resilience)"""
+
+    def __init__(self, underlying: Embeddings, model: str):
+        self.underlying = underlying
+        self.model = model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with span("embedding.call") as m:
+            return call_upstream([self.model], lambda _, __: self.underlying.embed_documents(texts), m)
+
+    def embed_query(self, text: str) -> List[float]:
+        with span("embedding.call") as m:
+            return call_upstream([self.model], lambda _, __: self.underlying.embed_query(text), m)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        with span("embedding.call") as m:
+            return await acall_upstream(
+                [self.model], lambda _, __: self.underlying.aembed_documents(texts), m, config.EMBEDDING_TIMEOUT
+            )
+
+    async def aembed_query(self, text: str) -> List[float]:
+        with span("embedding.call") as m:
+            return await acall_upstream(
+                [self.model], lambda _, __: self.underlying.aembed_query(text), m, config.EMBEDDING_TIMEOUT
+            )
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    在任意 Embedding 后端外包一层持久化缓存 (SQLite，key 为 模型标识 + 文本哈希)，
+    重复的查询与重复入库的文本不再重新计算 / 请求接口。
+    """
+
+    def __init__(self, underlying: Embeddings, model_id: str, path: str):
+        self.underlying = underlying
+        self.model_id = model_id
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _key(self, text: str) -> str:
+        return hash_bytes(self.model_id, text)
+
+    def _lookup(self, keys):
+        found = {}
+        with self._lock, self._connect() as conn:
+            # 分段查询，避免超出 SQLite 变量数上限
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                found.update({key: np.frombuffer(blob, dtype=np.float32).tolist() for key, blob in rows})
+        return found
+
+    def _store(self, found, texts, vectors) -> None:
+        rows = []
+        for text, vector in zip(texts, vectors):
+            key = self._key(text)
+            found[key] = list(vector)
+            rows.append((key, np.asarray(vector, dtype=np.float32).tobytes()))
+        with self._lock, self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        found = self._lookup(keys)
+        missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in found))
+        if missing:
+            self._store(found, missing, self.underlying.embed_documents(missing))
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        found = self._lookup(keys)
+        missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in found))
+        if missing:
+            # 远程接口走异步 HTTP 客户端；本地模型由基类放到线程池执行，不阻塞事件循环
+            self._store(found, missing, await self.underlying.aembed_documents(missing))
+        return [found[key] for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
@@ -1,12 +1,166 @@
-from langchain_openai import ChatOpenAI
+import asyncio
+import threading
+import weakref
+import httpx
 import config
+from core.embeddings import CachedEmbeddings, LocalEmbeddings, ResilientEmbeddings, embedding_model_id
 
-def get_llm():
-    llm = ChatOpenAI(
-        model=config.MODEL_NAME,      
-        openai_api_key=config.API_KEY,  
+# langchain_openai / langchain_core.rate_limiters 导入较慢 (秒级)，在首次创建客户端时才导入，
+# 这样 import core.* 本身很快，Streamlit 启动、worker 进程拉起和工具脚本都不必等待
+
+# 进程级客户端注册表：文本 / 视觉 / Embedding 客户端与 HTTP 连接池只创建一次，
+# Streamlit 脚本重跑、多会话并发时都复用同一批 keep-alive 连接，省去重复的 TLS 握手
+_registry = {}
+_registry_lock = threading.RLock()
+
+def _get_or_create(name, factory):
+    client = _registry.get(name)
+    if client is None:
+        with _registry_lock:
+            client = _registry.get(name)
+            if client is None:
+                client = factory()
+                _registry[name] = client
+    return client
+
+def get_http_client():
+    return _get_or_create("http_client", lambda: httpx.Client(
+        limits=httpx.Limits(
+            max_connections=config.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=config.HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+        )
+    ))
+
+class _LoopLocalTransport(httpx.AsyncBaseTransport):
+    """
+    httpx 的异步连接绑定在创建它的事件循环上，不能跨循环复用。
+    这里按事件循环各建一个连接池：同一个循环里的所有协程共享 keep-alive 连接，
+    多次 asyncio.run (批量脚本、基准) 也不会拿到已关闭循环上的旧连接。
+    """
+
+    def __init__(self, limits: httpx.Limits):
+        self._limits = limits
+        self._transports = weakref.WeakKeyDictionary()
+
+    async def handle_async_request(self, request):
+        loop = asyncio.get_running_loop()
+        transport = self._transports.get(loop)
+        if transport is None:
+            transport = httpx.AsyncHTTPTransport(limits=self._limits)
+            self._transports[loop] = transport
+        return await transport.handle_async_request(request)
+
+    async def aclose(self):
+        transport = self._transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
+
+def get_http_async_client():
+    """异步调用 (ainvoke / astream / aembed) 共享的 HTTP 客户端"""
+    return _get_or_create("http_async_client", lambda: httpx.AsyncClient(
+        transport=_LoopLocalTransport(httpx.Limits(
+            max_connections=config.HTTP_ASYNC_MAX_CONNECTIONS,
+            max_keepalive_connections=config.HTTP_ASYNC_MAX_CONNECTIONS,
+            keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+        ))
+    ))
+
+def _make_rate_limiter(requests_per_second: float):
+    """令牌桶限流器，同一模型的所有调用 (跨线程/协程) 共享一个桶"""
+    if not requests_per_second:
+        return None
+    from langchain_core.rate_limiters import InMemoryRateLimiter
+
+    return InMemoryRateLimiter(
+        requests_per_second=requests_per_second,
+        check_every_n_seconds=0.05,
+        max_bucket_size=max(1, requests_per_second),
+    )
+
+def text_models():
+    """主模型 + 降级模型，按顺序尝试"""
+    return [config.MODEL_NAME] + [m for m in config.TEXT_LLM_FALLBACKS if m != config.MODEL_NAME]
+
+def vision_models():
+    return [config.VISION_MODEL_NAME] + [m for m in config.VISION_LLM_FALLBACKS if m != config.VISION_MODEL_NAME]
+
+# 客户端自身不重试 (max_retries=0)，重试、降级与熔断统一由 core.resilience 处理
+def _create_text_llm(model: str):
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(
+        model=model,      
+        openai_api_key=config.require_api_key(),  
         openai_api_base=config.BASE_URL,
         temperature=0.7,              
-        max_tokens=2048
+        max_tokens=config.GENERATION_MAX_TOKENS,  # 每次请求按字数要求另行下调
+        stream_usage=True,  # 流式返回时同样带回 token 用量，供埋点统计
+        timeout=config.TEXT_LLM_TIMEOUT,
+        max_retries=0,
+        http_client=get_http_client(),
+        http_async_client=get_http_async_client(),
+        rate_limiter=_make_rate_limiter(config.TEXT_LLM_RPS)
+    )
+
+def _create_vision_llm(model: str):
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(
+        model=model,
+        openai_api_key=config.require_api_key(),
+        openai_api_base=config.BASE_URL,
+        temperature=0.01,
+        max_tokens=1024,
+        timeout=config.VISION_LLM_TIMEOUT,
+        max_retries=0,
+        http_client=get_http_client(),
+        http_async_client=get_http_async_client(),
+        rate_limiter=_make_rate_limiter(config.VISION_LLM_RPS)
     )
-    return llm
\ No newline at end of file
+
+def get_llm(model: str = None):
+    model = model or config.MODEL_NAME
+    return _get_or_create(f"text_llm:{model}", lambda: _create_text_llm(model))
+
+def get_vision_llm(model: str = None):
+    model = model or config.VISION_MODEL_NAME
+    return _get_or_create(f"vision_llm:{model}", lambda: _create_vision_llm(model))
+
+def _create_embeddings():
+    if config.EMBEDDING_BACKEND == "local":
+        embeddings = LocalEmbeddings(
+            config.LOCAL_EMBEDDING_MODEL,
+            device=config.LOCAL_EMBEDDING_DEVICE,
+            batch_size=config.LOCAL_EMBEDDING_BATCH_SIZE,
+            runtime=config.LOCAL_EMBEDDING_RUNTIME,
+        )
+    elif config.EMBEDDING_BACKEND == "dashscope":
+        from langchain_openai import OpenAIEmbeddings
+
+        embeddings = OpenAIEmbeddings(
+            model=config.EMBEDDING_MODEL_NAME,
+            openai_api_key=config.require_api_key(),
+            openai_api_base=config.BASE_URL,
+            check_embedding_ctx_length=False,
+            chunk_size=config.EMBEDDING_BATCH_SIZE,
+            timeout=config.EMBEDDING_TIMEOUT,
+            max_retries=0,
+            http_client=get_http_client(),
+            http_async_client=get_http_async_client()
+        )
+        # 只重试与熔断，不降级：换 Embedding 模型等于换向量空间
+        embeddings = ResilientEmbeddings(embeddings, config.EMBEDDING_MODEL_NAME)
+    else:
+        raise ValueError(f"未知的 EMBEDDING_BACKEND: {config.EMBEDDING_BACKEND}")
+
+    if config.EMBEDDING_CACHE_PATH:
+        embeddings = CachedEmbeddings(embeddings, embedding_model_id(), config.EMBEDDING_CACHE_PATH)
+    return embeddings
+
+def get_embeddings():
+    """
+    Embedding 客户端 (按 config.EMBEDDING_BACKEND 选择阿里云接口或本地模型)，
+    本地模型每个进程只加载一次，外层带持久化缓存
+    """
+    return _get_or_create("embeddings", _create_embeddings)
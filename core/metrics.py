@@ -0,0 +1,295 @@
+import atexit
+import contextvars
+import functools
+import inspect
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+
+# 当前请求的埋点记录列表。LangGraph 在线程池里执行节点时会复制 context，
+# 列表对象本身是共享的，所以各节点的记录都能汇总到同一次请求里
+_current_trace = contextvars.ContextVar("ecommate_trace", default=None)
+
+# 进程内聚合值，用于 Prometheus 文本导出
+_totals = {}
+_totals_lock = threading.Lock()
+
+# 当前状态类指标 (如各模型熔断器状态)：(指标名, 标签) -> 值
+_gauges = {}
+
+_sqlite_lock = threading.Lock()
+_sqlite_ready = False
+
+
+def start_trace() -> list:
+    """
+    开始记录一次请求，返回该请求的记录列表 (各阶段结束后陆续追加)。
+    """
+    trace = []
+    trace_id = uuid.uuid4().hex[:12]
+    trace.append({"name": "trace.start", "trace_id": trace_id, "ts": time.time()})
+    _current_trace.set(trace)
+    return trace
+
+
+def trace_id() -> str:
+    trace = _current_trace.get()
+    return trace[0]["trace_id"] if trace else ""
+
+
+@contextmanager
+def span(name: str, **fields):
+    """
+    记录一个阶段 (节点或外部调用) 的耗时。with 块内可向返回的 dict 补充字段：
+    ttft / prompt_tokens / completion_tokens / cache_hit / payload_bytes 等。
+    """
+    record = {"name": name, **fields}
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["wall"] = round(time.perf_counter() - start, 4)
+        emit(record)
+
+
+def timed(name: str):
+    """装饰器版 span，用于工作流节点 (同步函数与协程函数均可)"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_usage(record: dict, message) -> None:
+    """从 LangChain 返回消息的 usage_metadata 中提取 token 数"""
+    usage = getattr(message, "usage_metadata", None) or {}
+    if usage:
+        record["prompt_tokens"] = usage.get("input_tokens")
+        record["completion_tokens"] = usage.get("output_tokens")
+
+
+def set_gauge(name: str, labels: dict, value: float) -> None:
+    with _totals_lock:
+        _gauges[(name, tuple(sorted(labels.items())))] = value
+
+
+def emit(record: dict) -> None:
+    record.setdefault("trace_id", trace_id())
+    record.setdefault("ts", time.time())
+
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.append(record)
+
+    _aggregate(record)
+
+    if config.METRICS_LOG:
+        print(f"[metrics] {json.dumps(record, ensure_ascii=False, default=str)}")
+    if config.METRICS_SQLITE_PATH:
+        # 请求路径上不做磁盘 I/O：交给后台线程批量写入，队列满时丢弃
+        try:
+            _get_writer().put_nowait(record)
+        except queue.Full:
+            with _totals_lock:
+                _dropped["count"] += 1
+
+
+def _aggregate(record: dict) -> None:
+    name = record["name"]
+    with _totals_lock:
+        totals = _totals.setdefault(name, {
+            "count": 0, "wall_sum": 0.0, "errors": 0,
+            "prompt_tokens": 0, "completion_tokens": 0,
+            "cache_hit": 0, "cache_miss": 0, "payload_bytes": 0,
+            "retries": 0, "hedged": 0, "fallback": 0,
+        })
+        totals["count"] += 1
+        totals["wall_sum"] += record.get("wall", 0.0)
+        totals["errors"] += 1 if record.get("error") else 0
+        totals["prompt_tokens"] += record.get("prompt_tokens") or 0
+        totals["completion_tokens"] += record.get("completion_tokens") or 0
+        totals["payload_bytes"] += record.get("payload_bytes") or 0
+        totals["retries"] += record.get("retries") or 0
+        totals["hedged"] += 1 if record.get("hedged") else 0
+        totals["fallback"] += 1 if record.get("fallback_model") else 0
+        if record.get("cache_hit") is True:
+            totals["cache_hit"] += 1
+        elif record.get("cache_hit") is False:
+            totals["cache_miss"] += 1
+
+
+_writer_queue = None
+_writer_lock = threading.Lock()
+_dropped = {"count": 0}
+
+
+def _get_writer() -> queue.Queue:
+    """首次落盘时启动后台写入线程"""
+    global _writer_queue
+    if _writer_queue is None:
+        with _writer_lock:
+            if _writer_queue is None:
+                q = queue.Queue(maxsize=config.METRICS_QUEUE_SIZE)
+                threading.Thread(target=_writer_loop, args=(q,), name="metrics-writer", daemon=True).start()
+                atexit.register(flush_metrics)
+                _writer_queue = q
+    return _writer_queue
+
+
+def _writer_loop(q: queue.Queue) -> None:
+    while True:
+        batch = [q.get()]
+        # 攒一批再写：最多 METRICS_BATCH_SIZE 条或等待 METRICS_FLUSH_INTERVAL 秒
+        deadline = time.monotonic() + config.METRICS_FLUSH_INTERVAL
+        while len(batch) < config.METRICS_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(q.get(timeout=timeout))
+            except queue.Empty:
+                break
+        try:
+            _write_sqlite(batch)
+        except Exception as e:
+            # 埋点失败不能影响主流程，写入线程也不能退出 (否则 flush_metrics 会一直等待)
+            print(f"埋点写入失败: {e}")
+        finally:
+            for _ in batch:
+                q.task_done()
+
+
+def flush_metrics() -> None:
+    """等待已提交的埋点全部写入 (进程退出时自动调用)"""
+    if _writer_queue is not None:
+        _writer_queue.join()
+
+
+def _write_sqlite(records: list) -> None:
+    global _sqlite_ready
+    path = config.METRICS_SQLITE_PATH
+    known = {"ts", "trace_id", "name", "wall", "ttft", "prompt_tokens",
+             "completion_tokens", "cache_hit", "payload_bytes", "error"}
+    rows = [
+        (
+            record["ts"], record["trace_id"], record["name"], record.get("wall"),
+            record.get("ttft"), record.get("prompt_tokens"), record.get("completion_tokens"),
+            record.get("cache_hit"), record.get("payload_bytes"), record.get("error"),
+            json.dumps({k: v for k, v in record.items() if k not in known}, ensure_ascii=False, default=str),
+        )
+        for record in records
+    ]
+    with _sqlite_lock:
+        if not _sqlite_ready:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with sqlite3.connect(path, timeout=10) as conn:
+            if not _sqlite_ready:
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS metrics (
+                        ts REAL, trace_id TEXT, name TEXT, wall REAL, ttft REAL,
+                        prompt_tokens INTEGER, completion_tokens INTEGER,
+                        cache_hit INTEGER, payload_bytes INTEGER, error TEXT, extra TEXT
+                    )
+                    """
+                )
+                _sqlite_ready = True
+            conn.executemany("INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def render_prometheus() -> str:
+    """导出 Prometheus 文本格式的聚合指标"""
+    with _totals_lock:
+        snapshot = {name: dict(totals) for name, totals in _totals.items()}
+        gauges = dict(_gauges)
+        dropped = _dropped["count"]
+
+    lines = [
+        "# HELP ecommate_stage_seconds 各阶段耗时",
+        "# TYPE ecommate_stage_seconds summary",
+    ]
+    for name, t in sorted(snapshot.items()):
+        lines.append(f'ecommate_stage_seconds_count{{stage="{name}"}} {t["count"]}')
+        lines.append(f'ecommate_stage_seconds_sum{{stage="{name}"}} {t["wall_sum"]:.4f}')
+    lines += ["# TYPE ecommate_stage_errors_total counter"]
+    for name, t in sorted(snapshot.items()):
+        lines.append(f'ecommate_stage_errors_total{{stage="{name}"}} {t["errors"]}')
+    lines += ["# TYPE ecommate_tokens_total counter"]
+    for name, t in sorted(snapshot.items()):
+        if t["prompt_tokens"] or t["completion_tokens"]:
+            lines.append(f'ecommate_tokens_total{{stage="{name}",kind="prompt"}} {t["prompt_tokens"]}')
+            lines.append(f'ecommate_tokens_total{{stage="{name}",kind="completion"}} {t["completion_tokens"]}')
+    lines += ["# TYPE ecommate_cache_total counter"]
+    for name, t in sorted(snapshot.items()):
+        if t["cache_hit"] or t["cache_miss"]:
+            lines.append(f'ecommate_cache_total{{stage="{name}",result="hit"}} {t["cache_hit"]}')
+            lines.append(f'ecommate_cache_total{{stage="{name}",result="miss"}} {t["cache_miss"]}')
+    lines += ["# TYPE ecommate_payload_bytes_total counter"]
+    for name, t in sorted(snapshot.items()):
+        if t["payload_bytes"]:
+            lines.append(f'ecommate_payload_bytes_total{{stage="{name}"}} {t["payload_bytes"]}')
+    for metric, field in (("ecommate_upstream_retries_total", "retries"),
+                          ("ecommate_upstream_hedged_total", "hedged"),
+                          ("ecommate_upstream_fallback_total", "fallback")):
+        lines.append(f"# TYPE {metric} counter")
+        for name, t in sorted(snapshot.items()):
+            if t[field]:
+                lines.append(f'{metric}{{stage="{name}"}} {t[field]}')
+    lines += ["# TYPE ecommate_metrics_dropped_total counter", f"ecommate_metrics_dropped_total {dropped}"]
+    # 状态类指标，如 ecommate_circuit_state (熔断器：0 closed / 1 half_open / 2 open)
+    for metric in sorted({metric for metric, _ in gauges}):
+        lines.append(f"# TYPE {metric} gauge")
+        for (name, labels), value in sorted(gauges.items()):
+            if name == metric:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{metric}{{{label_text}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int = None):
+    """在后台线程启动 /metrics 文本端点，port 为 0 时不启动"""
+    port = config.METRICS_PORT if port is None else port
+    if not port:
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Prometheus 指标端点已启动: http://0.0.0.0:{port}/metrics")
+    return server
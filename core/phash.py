@@ -0,0 +1,218 @@
+import functools
+import io
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from core.metrics import trace_id
+
+_CHUNKS = 4
+_CHUNK_BITS = 16
+_CHUNK_MASK = (1 << _CHUNK_BITS) - 1
+
+
+def image_fingerprint(image_bytes: bytes) -> Tuple[int, Tuple[int, int, int]]:
+    """
+    计算 64 位 dHash (相邻像素灰度差) 与平均颜色。
+    dHash 对缩放、重新压缩、轻微裁剪和调色不敏感，但不区分颜色，
+    因此另外返回平均 RGB，用来排除“同款不同色”的误匹配。
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    # JPEG 直接按缩小后的尺寸解码，省去解码整张大图
+    image.draft("RGB", (64, 64))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+
+    mean_color = image.resize((1, 1), Image.BOX).getpixel((0, 0))
+    pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left, right = pixels[row * 9 + col], pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value, tuple(mean_color)
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+@functools.lru_cache(maxsize=None)
+def _chunk_masks(radius: int) -> Tuple[int, ...]:
+    """16 位分段内 Hamming 距离不超过 radius 的全部异或掩码"""
+    masks = []
+    for r in range(radius + 1):
+        for bits in itertools.combinations(range(_CHUNK_BITS), r):
+            masks.append(sum(1 << b for b in bits))
+    return tuple(masks)
+
+
+class MultiIndexHash:
+    """
+    64 位哈希的多索引哈希 (multi-index hashing)：把哈希切成 4 段 16 位，每段各建一张 段值 -> 条目 的表。
+    两个哈希距离不超过 r 时，至少有一段的距离不超过 r // 4 (抽屉原理)，
+    所以查询只需在每段枚举这么多位的翻转、取出候选，再逐个核对完整距离。
+    r <= 7 时每段只查 17 个桶，几十万条目下也只需核对几百个候选。
+    """
+
+    def __init__(self):
+        self._entries = []  # [(hash, payload)]
+        self._positions = {}  # hash -> 在 _entries 中的位置
+        self._tables = [{} for _ in range(_CHUNKS)]
+
+    @staticmethod
+    def _chunks(value: int):
+        return [(value >> (i * _CHUNK_BITS)) & _CHUNK_MASK for i in range(_CHUNKS)]
+
+    def add(self, value: int, payload) -> None:
+        position = self._positions.get(value)
+        if position is not None:
+            # 完全相同的哈希只保留最新一条
+            self._entries[position] = (value, payload)
+            return
+        position = len(self._entries)
+        self._entries.append((value, payload))
+        self._positions[value] = position
+        for table, chunk in zip(self._tables, self._chunks(value)):
+            table.setdefault(chunk, []).append(position)
+
+    def search(self, value: int, radius: int) -> List[Tuple[int, object]]:
+        """返回所有距离不超过 radius 的 (距离, payload)，按距离从近到远排序"""
+        masks = _chunk_masks(radius // _CHUNKS)
+        candidates = set()
+        for table, chunk in zip(self._tables, self._chunks(value)):
+            for mask in masks:
+                bucket = table.get(chunk ^ mask)
+                if bucket:
+                    candidates.update(bucket)
+        found = []
+        for position in candidates:
+            other, payload = self._entries[position]
+            distance = hamming(value, other)
+            if distance <= radius:
+                found.append((distance, payload))
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class PerceptualIndex:
+    """
+    已解析图片的感知哈希索引：哈希、平均颜色与视觉解析结果一起存在本地 SQLite，
+    首次查询时整体载入内存中的多索引哈希表。namespace 区分视觉模型 / Prompt 版本，版本变化后旧条目不再命中。
+    每次复用都写入 phash_reuse 表，便于事后抽查。
+    """
+
+    def __init__(self, path: str, namespace: str, max_distance: int, max_color_delta: int):
+        self.path = path
+        self.namespace = namespace
+        self.max_distance = max_distance
+        self.max_color_delta = max_color_delta
+        self._index = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS phash_index (
+                    namespace TEXT NOT NULL,
+                    cache_key TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    mean_color TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, cache_key)
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS phash_reuse (
+                    ts REAL NOT NULL,
+                    trace_id TEXT,
+                    namespace TEXT NOT NULL,
+                    query_hash TEXT NOT NULL,
+                    matched_key TEXT NOT NULL,
+                    distance INTEGER NOT NULL,
+                    color_delta INTEGER NOT NULL
+                )
+                """
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _get_index(self) -> MultiIndexHash:
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    start = time.perf_counter()
+                    index = MultiIndexHash()
+                    with self._connect() as conn:
+                        rows = conn.execute(
+                            "SELECT cache_key, hash, mean_color FROM phash_index WHERE namespace = ?",
+                            (self.namespace,),
+                        ).fetchall()
+                    for cache_key, value, mean_color in rows:
+                        index.add(int(value, 16), (cache_key, tuple(json.loads(mean_color))))
+                    self._index = index
+                    print(f"感知哈希索引已载入: {len(index)} 张图片，耗时 {time.perf_counter() - start:.2f}s")
+        return self._index
+
+    def lookup(self, value: int, mean_color) -> Optional[Tuple[dict, int, int]]:
+        """
+        查找近似重复的已解析图片，返回 (解析结果, Hamming 距离, 颜色差) 或 None。
+        命中时记录一条复用日志。
+        """
+        index = self._get_index()
+        with self._lock:
+            candidates = index.search(value, self.max_distance)
+        for distance, (cache_key, color) in candidates:
+            color_delta = max(abs(a - b) for a, b in zip(color, mean_color))
+            if color_delta > self.max_color_delta:
+                continue
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT result FROM phash_index WHERE namespace = ? AND cache_key = ?",
+                    (self.namespace, cache_key),
+                ).fetchone()
+                if row is None:
+                    continue
+                conn.execute(
+                    "INSERT INTO phash_reuse VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (time.time(), trace_id(), self.namespace, f"{value:016x}", cache_key, distance, color_delta),
+                )
+            return json.loads(row[0]), distance, color_delta
+        return None
+
+    def add(self, value: int, mean_color, cache_key: str, result: dict) -> None:
+        mean_color = tuple(mean_color)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO phash_index VALUES (?, ?, ?, ?, ?, ?)",
+                (self.namespace, cache_key, f"{value:016x}", json.dumps(mean_color),
+                 json.dumps(result, ensure_ascii=False), time.time()),
+            )
+        # 索引尚未载入时无需更新内存，载入时会从数据库读到这条
+        if self._index is not None:
+            with self._lock:
+                self._index.add(value, (cache_key, mean_color))
+
+    def recent_reuses(self, limit: int = 50) -> List[dict]:
+        """最近的复用记录，供运维抽查近似匹配是否合理"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT ts, trace_id, query_hash, matched_key, distance, color_delta FROM phash_reuse "
+                "WHERE namespace = ? ORDER BY ts DESC LIMIT ?",
+                (self.namespace, limit),
+            ).fetchall()
+        keys = ("ts", "trace_id", "query_hash", "matched_key", "distance", "color_delta")
+        return [dict(zip(keys, row)) for row in rows]
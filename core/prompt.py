@@ -0,0 +1,173 @@
+import re
+import threading
+from typing import Dict, List, Tuple
+
+import config
+
+# 固定不变的指令放在最前面 (system)，每次请求完全相同，
+# 服务端的前缀缓存 (prompt caching) 可以直接复用这部分
+GENERATION_SYSTEM_PROMPT = """你是一个金牌电商文案撰写专家，根据商品信息撰写吸引人的营销文案。
+要求：
+1. 必须符合指定的风格。
+2. 突出商品的视觉亮点（如颜色、材质）。
+3. 用户特别要求必须优先满足。
+4. 严格遵守字数限制，宁缺毋滥。
+5. 参考范例只学习语气和结构，不要照抄。
+6. 不要用“YYDS”“绝绝子”这类泛滥词。
+7. 直接输出文案内容，不要包含“根据以上信息...”等废话。"""
+
+# 视觉解析字段 -> 中文标签，按此顺序紧凑渲染
+ATTRIBUTE_LABELS = {
+    "description": "外观",
+    "style": "风格",
+    "color_palette": "主色",
+    "color": "主色",
+    "material": "材质",
+    "target_audience": "人群",
+}
+
+
+_encoding = None
+_encoding_ready = threading.Event()
+_encoding_started = False
+_encoding_lock = threading.Lock()
+
+
+def _load_encoding():
+    global _encoding
+    try:
+        import tiktoken
+        _encoding = tiktoken.get_encoding(config.PROMPT_TOKENIZER)
+    except Exception as e:
+        print(f"tokenizer 加载失败，改用字符数估算 token: {e}")
+    finally:
+        _encoding_ready.set()
+
+
+def _start_loading() -> None:
+    """
+    后台线程加载 tiktoken 编码。首次使用需要下载词表 (tiktoken 下载不带超时)，
+    放在请求里会让第一个生成请求卡住，所以只在后台加载，只尝试一次。
+    """
+    global _encoding_started
+    with _encoding_lock:
+        if _encoding_started:
+            return
+        _encoding_started = True
+    threading.Thread(target=_load_encoding, name="tokenizer-load", daemon=True).start()
+
+
+def warmup_tokenizer(timeout: float = None) -> bool:
+    """服务启动时预热 tokenizer，最多等待 timeout 秒，返回是否已可用"""
+    if not config.PROMPT_TOKENIZER:
+        return False
+    _start_loading()
+    _encoding_ready.wait(config.PROMPT_TOKENIZER_TIMEOUT if timeout is None else timeout)
+    return _encoding is not None
+
+
+def _get_encoding():
+    """tokenizer 已加载好时返回编码，否则返回 None (按字符数估算)，从不阻塞请求"""
+    if not config.PROMPT_TOKENIZER:
+        return None
+    if not _encoding_ready.is_set():
+        _start_loading()
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # 估算：中文按 1 字 1 token，其余按 4 个字符 1 token
+    cjk = len(re.findall(r"[\u4e00-\u9fff\u3000-\u303f\uff00-\uffef]", text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """按 token 数截断 (二分查找字符位置)，截断处补省略号"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid]) + 1 <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low].rstrip() + "…"
+
+
+def render_attributes(image_data: Dict) -> str:
+    """把视觉解析结果渲染成 “外观：…；风格：…” 的紧凑文本，去掉空值与 “未知”"""
+    parts = []
+    seen = set()
+    for key, label in ATTRIBUTE_LABELS.items():
+        value = (image_data or {}).get(key)
+        if isinstance(value, (list, tuple)):
+            value = "、".join(str(v) for v in value if v)
+        if not value or value == "未知" or label in seen:
+            continue
+        seen.add(label)
+        parts.append(f"{label}：{value}")
+    return "；".join(parts) or "无"
+
+
+def fit_examples(examples: List[str], budget: int) -> Tuple[List[str], int]:
+    """
+    把参考范例压缩到 budget 个 token 以内：按顺序平均分配预算，超出的截断，
+    剩余预算太少时丢弃后面的范例。返回 (范例列表, 被截断或丢弃的条数)。
+    """
+    fitted, trimmed = [], 0
+    remaining = budget
+    for i, example in enumerate(examples):
+        share = remaining // (len(examples) - i)
+        if share < config.PROMPT_MIN_EXAMPLE_TOKENS:
+            trimmed += len(examples) - i
+            break
+        text = truncate_to_tokens(example, share)
+        if text != example:
+            trimmed += 1
+        fitted.append(text)
+        remaining -= count_tokens(text)
+    return fitted, trimmed
+
+
+def max_tokens_for(words_limit) -> int:
+    """按字数要求推算输出 token 上限 (留出余量)，无法解析时用默认上限"""
+    try:
+        words = int(str(words_limit).strip())
+    except ValueError:
+        return config.GENERATION_MAX_TOKENS
+    if words <= 0:
+        return config.GENERATION_MAX_TOKENS
+    estimate = int(words * config.GENERATION_TOKENS_PER_WORD) + 64
+    return max(64, min(config.GENERATION_MAX_TOKENS, estimate))
+
+
+def build_generation_messages(state: Dict):
+    """
+    组装文案生成的消息：固定的 system 前缀 + 本次请求的商品信息、风格、范例。
+    返回 (messages, 统计信息)，统计信息记入埋点。
+    """
+    from langchain_core.messages import HumanMessage, SystemMessage
+
+    limit = state.get('words_limit') or '适中'
+    note = state.get('user_note') or '无'
+    examples, trimmed = fit_examples(list(state.get('retrieved_examples') or []), config.PROMPT_EXAMPLE_TOKEN_BUDGET)
+    example_lines = "\n".join(f"- {ex}" for ex in examples) or "无"
+
+    user_prompt = (
+        f"【商品信息】{render_attributes(state.get('image_data'))}\n"
+        f"【风格】{state['user_style']}\n"
+        f"【字数】{limit} 字以内\n"
+        f"【用户特别要求】{note}\n"
+        f"【参考范例】\n{example_lines}"
+    )
+    messages = [SystemMessage(content=GENERATION_SYSTEM_PROMPT), HumanMessage(content=user_prompt)]
+    stats = {
+        "prompt_tokens_estimate": count_tokens(GENERATION_SYSTEM_PROMPT) + count_tokens(user_prompt),
+        "examples_trimmed": trimmed,
+        "max_tokens": max_tokens_for(state.get('words_limit')),
+    }
+    return messages, stats
@@ -1,69 +1,451 @@
+import asyncio
+import csv
+import json
+import math
 import os
-import pandas as pd
+import re
+import threading
+import numpy as np
 import config
-from langchain_openai import OpenAIEmbeddings
-from langchain_chroma import Chroma
 from langchain_core.documents import Document
+from core.cache import hash_bytes
+from core.embeddings import collection_name, embedding_model_id
+from core.llm import get_embeddings
+from core.metrics import span
 
-def get_embeddings():
+# 进程级向量库单例：所有 Streamlit 会话共享同一个 Chroma 句柄，避免每次检索都重新打开 SQLite
+_vector_store = None
+_vector_store_lock = threading.Lock()
+
+# 风格 -> 范例的内存索引，由 Chroma 数据构建，已知风格直接查表，无需 Embedding 调用
+_style_index = None
+# 带向量的风格分区索引，只在语义检索 / 自由文本风格检索第一次用到时才加载
+_style_vector_index = None
+
+# 前端下拉框中的风格名 -> 语料库 styles.csv 中的 style 标签
+STYLE_ALIASES = {
+    "小红书种草": ["小红书"],
+    "京东/淘宝电商": ["京东电商", "淘宝电商"],
+    "朋友圈私域": ["朋友圈"],
+    "抖音直播": ["抖音直播"],
+}
+
+def load_corpus():
     """
-    使用阿里云的 Embedding 服务
+    读取 styles.csv，为每行生成稳定的内容哈希 ID (style + content)。
+    内容完全相同的重复行只保留一份。
     """
-    return OpenAIEmbeddings(
-        model=config.EMBEDDING_MODEL_NAME,
-        openai_api_key=config.API_KEY,
-        openai_api_base=config.BASE_URL,
-        check_embedding_ctx_length=False 
-    )
+    csv_path = config.STYLES_CSV_PATH
+    if not os.path.exists(csv_path):
+        raise FileNotFoundError(f"找不到数据文件: {csv_path}")
+
+    corpus = {}
+    # 标准库 csv 即可，不为读一个小文件引入 pandas (导入要半秒以上)
+    with open(csv_path, encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            if not row.get('style') or not row.get('content'):
+                continue
+            doc_id = hash_bytes(row['style'], row['content'])[:32]
+            corpus[doc_id] = Document(
+                page_content=row['content'],
+                metadata={"style": row['style']}
+            )
+    return corpus
+
+def _manifest_path():
+    # 每个 collection (即每个 Embedding 模型) 各自记录同步状态
+    return os.path.join(config.VECTOR_DB_DIR, f"manifest_{collection_name()}.json")
+
+def _read_manifest():
+    try:
+        with open(_manifest_path(), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def sync_index(vector_store, force: bool = False):
+    """
+    把 styles.csv 增量同步到向量库：
+    - CSV 文件与 Embedding 模型都没变时 (manifest 比对) 直接跳过，不读库、不调接口；
+    - 只为新增 / 修改的行调用 Embedding (分批请求)；
+    - 删除 CSV 中已不存在的行。
+    返回 {"added": n, "deleted": n}。
+    """
+    global _style_index, _style_vector_index
+    with open(config.STYLES_CSV_PATH, "rb") as f:
+        csv_hash = hash_bytes(f.read())
+
+    manifest = _read_manifest()
+    if (not force and manifest.get("csv_sha256") == csv_hash
+            and manifest.get("embedding_model") == embedding_model_id()):
+        return {"added": 0, "deleted": 0}
+
+    corpus = load_corpus()
+    existing_ids = set(vector_store.get(include=[])["ids"])
+
+    new_ids = [doc_id for doc_id in corpus if doc_id not in existing_ids]
+    removed_ids = [doc_id for doc_id in existing_ids if doc_id not in corpus]
+
+    if removed_ids:
+        print(f"向量库同步：删除 {len(removed_ids)} 条已移除的范例")
+        vector_store.delete(ids=removed_ids)
+
+    batch_size = config.EMBEDDING_BATCH_SIZE
+    for start in range(0, len(new_ids), batch_size):
+        batch = new_ids[start:start + batch_size]
+        print(f"向量库同步：写入第 {start + 1}-{start + len(batch)} / {len(new_ids)} 条新范例")
+        vector_store.add_documents([corpus[doc_id] for doc_id in batch], ids=batch)
+
+    # 语料有变化，风格索引下次访问时重建
+    _style_index = None
+    _style_vector_index = None
+
+    # 全部写入成功后才更新 manifest，中途失败下次启动会重新对比补齐
+    with open(_manifest_path(), "w", encoding="utf-8") as f:
+        json.dump({
+            "csv_sha256": csv_hash,
+            "embedding_model": embedding_model_id(),
+            "count": len(corpus),
+        }, f, ensure_ascii=False, indent=2)
+
+    return {"added": len(new_ids), "deleted": len(removed_ids)}
 
 def initialize_rag():
     """
-    如果本地已经有数据库，直接加载；
-    如果没有，从 CSV 初始化。
+    打开本地向量库 (不存在则新建)，并与 styles.csv 做一次增量同步。
+    collection 按 Embedding 后端 + 模型命名，切换后端时新 collection 为空，会自动全量重建。
+    """
+    # langchain_chroma (连带 chromadb) 导入较慢，首次打开向量库时才导入
+    from langchain_chroma import Chroma
+
+    print(f"正在加载本地向量库 (collection: {collection_name()})...")
+    os.makedirs(config.VECTOR_DB_DIR, exist_ok=True)
+    vector_store = Chroma(
+        collection_name=collection_name(),
+        persist_directory=config.VECTOR_DB_DIR,
+        embedding_function=get_embeddings()
+    )
+
+    result = sync_index(vector_store)
+    if result["added"] or result["deleted"]:
+        print(f"向量库同步完成：新增 {result['added']} 条，删除 {result['deleted']} 条")
+
+    return vector_store
+
+def get_vector_store():
+    """
+    获取进程内共享的向量库句柄，首次调用时才初始化（线程安全）。
+    """
+    global _vector_store
+    if _vector_store is None:
+        with _vector_store_lock:
+            # 双重检查，防止多个会话同时触发初始化
+            if _vector_store is None:
+                _vector_store = initialize_rag()
+    return _vector_store
+
+def reload_vector_store():
+    """
+    语料 (styles.csv / chroma_db) 变更后调用，丢弃旧句柄，重新加载并增量同步。
+    """
+    global _vector_store, _style_index, _style_vector_index
+    with _vector_store_lock:
+        _vector_store = initialize_rag()
+        _style_index = None
+        _style_vector_index = None
+    return _vector_store
+
+def warmup_rag():
+    """
+    服务启动时预热：提前建立向量库句柄，避免第一个真实请求承担初始化开销。
+    """
+    return get_vector_store()
+
+def build_style_index(vector_store, with_vectors: bool = False):
+    """
+    从向量库一次性读出全部范例，按 style 标签分区：{style: {"documents": [范例文案, ...]}}。
+    with_vectors=True 时每个分区再带上归一化后的向量矩阵 "vectors"，语义检索在对应分区内做矩阵乘法，
+    比 Chroma 带 where 过滤的查询 (先走 SQLite 再走 HNSW) 快一个数量级以上。
+    向量很占内存 (10 万条 1536 维约 600MB)，已知风格查表用不到，默认不读。
+    """
+    include = ["documents", "metadatas", "embeddings"] if with_vectors else ["documents", "metadatas"]
+    documents, vectors = {}, {}
+    page_size, offset = 5000, 0
+    while True:
+        # 分页读取，避免大语料一次 get 超出 SQLite 变量数上限
+        data = vector_store.get(include=include, limit=page_size, offset=offset)
+        embeddings = data["embeddings"] if with_vectors else [None] * len(data["documents"])
+        for content, metadata, vector in zip(data["documents"], data["metadatas"], embeddings):
+            label = (metadata or {}).get("style")
+            if label:
+                documents.setdefault(label, []).append(content)
+                vectors.setdefault(label, []).append(vector)
+        if len(data["documents"]) < page_size:
+            break
+        offset += page_size
+
+    index = {}
+    for label, docs in documents.items():
+        index[label] = {"documents": docs}
+        if with_vectors:
+            matrix = np.asarray(vectors[label], dtype=np.float32)
+            matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12
+            index[label]["vectors"] = matrix
+    return index
+
+def get_style_index():
+    """
+    进程内共享的风格分区索引 (只有范例文本)，每个进程只构建一次。
+    只读取本地 SQLite，不会产生网络调用。带向量的索引已加载时直接复用它。
+    """
+    global _style_index
+    if _style_vector_index is not None:
+        return _style_vector_index
+    if _style_index is None:
+        vector_store = get_vector_store()
+        with _vector_store_lock:
+            if _style_index is None:
+                _style_index = build_style_index(vector_store)
+    return _style_index
+
+def get_style_vector_index():
+    """带向量的风格分区索引，语义检索第一次用到时才加载"""
+    global _style_index, _style_vector_index
+    if _style_vector_index is None:
+        vector_store = get_vector_store()
+        with _vector_store_lock:
+            if _style_vector_index is None:
+                _style_vector_index = build_style_index(vector_store, with_vectors=True)
+                # 带向量的索引同样包含全部范例文本，文本索引不再单独保留
+                _style_index = None
+    return _style_vector_index
+
+def resolve_style_labels(query_style: str):
+    """
+    把用户风格映射为语料库中的 style 标签：
+    1. 前端固定选项走 STYLE_ALIASES；
+    2. 与语料标签完全一致的直接使用；
+    3. 自由文本按子串做模糊匹配（例如“小红书风格” -> “小红书”）。
+    都匹配不上时返回空列表。
+    """
+    index = get_style_index()
+    if query_style in STYLE_ALIASES:
+        return [label for label in STYLE_ALIASES[query_style] if label in index]
+    if query_style in index:
+        return [query_style]
+    return [label for label in index if label in query_style or query_style in label]
+
+def style_filter(labels):
+    """style 标签 -> Chroma 元数据过滤条件"""
+    if len(labels) == 1:
+        return {"style": labels[0]}
+    if labels:
+        return {"style": {"$in": labels}}
+    return None
+
+def build_product_query(image_data: dict) -> str:
+    """
+    用视觉解析出的商品属性拼出语义检索的查询文本。
+    视觉解析失败 (兜底结果) 时返回空字符串。
+    """
+    if not image_data or image_data.get("description") in (None, "", "图片解析失败", "未知商品"):
+        return ""
+    parts = [image_data.get(key) for key in ("description", "style", "material", "target_audience")]
+    return "；".join(str(part) for part in parts if part and part != "未知")
+
+def _tokenize(text: str):
+    """BM25 分词：中文按字符二元组切分，英文/数字按单词切分，不依赖额外分词库"""
+    tokens = re.findall(r"[a-z0-9]+", text.lower())
+    for segment in re.findall(r"[\u4e00-\u9fff]+", text):
+        if len(segment) == 1:
+            tokens.append(segment)
+        tokens.extend(segment[i:i + 2] for i in range(len(segment) - 1))
+    return tokens
+
+def bm25_scores(query: str, documents, k1: float = 1.5, b: float = 0.75):
+    """在候选集合上计算 BM25 分数 (候选集很小，现算即可)"""
+    query_tokens = set(_tokenize(query))
+    doc_tokens = [_tokenize(doc) for doc in documents]
+    if not query_tokens or not doc_tokens:
+        return [0.0] * len(documents)
+    avg_len = sum(len(tokens) for tokens in doc_tokens) / len(doc_tokens) or 1.0
+    n_docs = len(doc_tokens)
+    doc_freq = {token: sum(1 for tokens in doc_tokens if token in tokens) for token in query_tokens}
+
+    scores = []
+    for tokens in doc_tokens:
+        counts = {}
+        for token in tokens:
+            if token in query_tokens:
+                counts[token] = counts.get(token, 0) + 1
+        score = 0.0
+        for token, tf in counts.items():
+            idf = math.log(1 + (n_docs - doc_freq[token] + 0.5) / (doc_freq[token] + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(tokens) / avg_len))
+        scores.append(score)
+    return scores
+
+def mmr_select(candidate_vectors, relevance, k: int, lambda_mult: float):
+    """
+    最大边际相关 (MMR)：在相关性与多样性之间权衡，避免选出几条几乎一样的范例。
+    relevance 为每个候选的相关性分数 (已归一化到 0~1)。
+    """
+    vectors = np.asarray(candidate_vectors, dtype=np.float32)
+    vectors = vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+    relevance = np.asarray(relevance, dtype=np.float32)
+
+    selected = []
+    max_sim_to_selected = np.zeros(len(vectors), dtype=np.float32)
+    while len(selected) < min(k, len(vectors)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_sim_to_selected
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        max_sim_to_selected = np.maximum(max_sim_to_selected, vectors @ vectors[best])
+    return selected
+
+def _vector_candidates(query_vector, labels, fetch_k: int, index, vector_store):
+    """
+    召回候选：有 style 标签时在内存分区中暴力计算余弦相似度 (style 为硬过滤)，
+    没有标签时走 Chroma 的无过滤 HNSW 查询。
+    返回按相似度降序排列的 (documents, vectors)。
     """
-    db_path = config.VECTOR_DB_DIR
-    embeddings = get_embeddings()
+    query = np.asarray(query_vector, dtype=np.float32)
+    query /= np.linalg.norm(query) + 1e-12
 
-    if os.path.exists(db_path) and os.listdir(db_path):
-        print("检测到本地向量库，正在加载...")
-        vector_store = Chroma(
-            persist_directory=db_path,
-            embedding_function=embeddings
+    if not labels:
+        result = vector_store._collection.query(
+            query_embeddings=[query.tolist()],
+            n_results=fetch_k,
+            include=["documents", "embeddings"],
         )
+        return result["documents"][0], np.asarray(result["embeddings"][0], dtype=np.float32)
+
+    documents, vectors, scores = [], [], []
+    for label in labels:
+        partition = index.get(label)
+        if not partition:
+            continue
+        sims = partition["vectors"] @ query
+        top = np.argpartition(-sims, fetch_k - 1)[:fetch_k] if len(sims) > fetch_k else np.arange(len(sims))
+        for i in top:
+            documents.append(partition["documents"][i])
+            vectors.append(partition["vectors"][i])
+            scores.append(sims[i])
+
+    order = np.argsort(-np.asarray(scores))[:fetch_k]
+    return [documents[i] for i in order], np.asarray([vectors[i] for i in order], dtype=np.float32)
+
+def search_examples(query_vector, query_text: str, labels, k: int, fetch_k: int = None,
+                    use_mmr: bool = None, rerank: str = None, index=None, vector_store=None):
+    """
+    语义检索主流程 (不含 Embedding 调用)：
+    1. style 作为硬过滤条件，向量召回 fetch_k 条候选；
+    2. 可选 BM25 重排：与向量排名做倒数排名融合 (RRF)；
+    3. 可选 MMR 多样化，选出最终 k 条。
+    index / vector_store 默认使用进程内共享的实例。
+    """
+    fetch_k = max(k, fetch_k or config.RAG_FETCH_K)
+    use_mmr = config.RAG_MMR if use_mmr is None else use_mmr
+    rerank = config.RAG_RERANK if rerank is None else rerank
+    if index is None and labels:
+        index = get_style_vector_index()
+    if vector_store is None and not labels:
+        vector_store = get_vector_store()
+
+    with span("rag.vector_search") as m:
+        documents, vectors = _vector_candidates(query_vector, labels, fetch_k, index, vector_store)
+        m["candidates"] = len(documents)
+    if not documents:
+        return []
+
+    # 向量排名即召回顺序，相关性按名次线性归一化到 (0, 1]
+    n = len(documents)
+    vector_rank = list(range(n))
+    if rerank == "bm25":
+        with span("rag.rerank"):
+            lexical = bm25_scores(query_text, documents)
+            lexical_rank = {i: r for r, i in enumerate(sorted(range(n), key=lambda i: -lexical[i]))}
+            fused = [1 / (60 + vector_rank[i]) + 1 / (60 + lexical_rank[i]) for i in range(n)]
+            order = sorted(range(n), key=lambda i: -fused[i])
     else:
-        print("正在初始化向量库 (第一次运行会比较慢)...")
-        csv_path = os.path.join("data", "styles.csv")
-        if not os.path.exists(csv_path):
-            raise FileNotFoundError(f"找不到数据文件: {csv_path}")
-            
-        df = pd.read_csv(csv_path)
-        
-        documents = []
-        for _, row in df.iterrows():
-            doc = Document(
-                page_content=row['content'],
-                metadata={"style": row['style']}
-            )
-            documents.append(doc)
-            
-        vector_store = Chroma.from_documents(
-            documents=documents,
-            embedding=embeddings,
-            persist_directory=db_path
-        )
-        print("向量库构建完成！")
-        
-    return vector_store
+        order = vector_rank
+    relevance = [0.0] * n
+    for rank, i in enumerate(order):
+        relevance[i] = 1 - rank / n
 
-def retrieve_examples(query_style: str, k: int = 3):
+    if use_mmr:
+        chosen = mmr_select(vectors, relevance, k, config.RAG_MMR_LAMBDA)
+    else:
+        chosen = order[:k]
+    return [documents[i] for i in chosen]
+
+def _lookup_style_examples(query_style: str, labels, index, k: int):
+    """已知风格直接查内存索引，多个标签（如 京东/淘宝）轮流取，保证每个平台都有范例"""
+    if query_style not in STYLE_ALIASES and query_style not in index:
+        return []
+    with span("rag.index_lookup") as m:
+        pools = [index[label]["documents"] for label in labels]
+        examples = []
+        for i in range(max((len(pool) for pool in pools), default=0)):
+            for pool in pools:
+                if i < len(pool) and len(examples) < k:
+                    examples.append(pool[i])
+        m["cache_hit"] = bool(examples)
+    return examples
+
+def retrieve_examples(query_style: str, k: int = 3, image_data: dict = None):
     """
     根据用户想要的风格 (query_style)，检索 k 个最相似的文案范例。
+    - 传入 image_data 且开启 RAG_SEMANTIC_RETRIEVAL 时：风格为硬过滤，商品属性为语义查询；
+    - 否则已知风格直接查内存索引；自由文本风格才走向量检索（带 style 过滤）。
+    """
+    print(f"正在检索风格: {query_style} ...")
+
+    index = get_style_index()
+    labels = resolve_style_labels(query_style)
+
+    product_query = build_product_query(image_data) if config.RAG_SEMANTIC_RETRIEVAL else ""
+    if product_query:
+        with span("rag.embedding", payload_bytes=len(product_query.encode("utf-8"))):
+            query_vector = get_embeddings().embed_query(product_query)
+        examples = search_examples(query_vector, product_query, labels, k)
+        if examples:
+            return examples
+
+    examples = _lookup_style_examples(query_style, labels, index, k)
+    if examples:
+        return examples
+
+    # 自由文本风格：用风格描述本身做查询，仍以匹配到的 style 标签为过滤条件
+    with span("rag.embedding", payload_bytes=len(query_style.encode("utf-8"))):
+        query_vector = get_embeddings().embed_query(query_style)
+    return search_examples(query_vector, query_style, labels, k, use_mmr=False, rerank="none")
+
+async def aretrieve_examples(query_style: str, k: int = 3, image_data: dict = None):
+    """
+    retrieve_examples 的异步版本：Embedding 走异步客户端；
+    首次加载向量库、向量召回与重排 (SQLite / numpy) 放到线程池，不阻塞事件循环。
     """
-    vector_store = initialize_rag()
-    
     print(f"正在检索风格: {query_style} ...")
-    
-    results = vector_store.similarity_search(query_style, k=k)
-    
-    examples = [doc.page_content for doc in results]
-    return examples
\ No newline at end of file
+
+    index = _style_index if _style_index is not None else await asyncio.to_thread(get_style_index)
+    labels = resolve_style_labels(query_style)
+
+    product_query = build_product_query(image_data) if config.RAG_SEMANTIC_RETRIEVAL else ""
+    if product_query:
+        with span("rag.embedding", payload_bytes=len(product_query.encode("utf-8"))):
+            query_vector = await get_embeddings().aembed_query(product_query)
+        examples = await asyncio.to_thread(search_examples, query_vector, product_query, labels, k)
+        if examples:
+            return examples
+
+    examples = _lookup_style_examples(query_style, labels, index, k)
+    if examples:
+        return examples
+
+    with span("rag.embedding", payload_bytes=len(query_style.encode("utf-8"))):
+        query_vector = await get_embeddings().aembed_query(query_style)
+    return await asyncio.to_thread(
+        search_examples, query_vector, query_style, labels, k, use_mmr=False, rerank="none"
+    )
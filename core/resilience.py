@@ -0,0 +1,476 @@
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+
+import config
+from core.metrics import set_gauge
+
+
+class UpstreamError(RuntimeError):
+    """候选模型全部失败、熔断或超出整体截止时间"""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """超时、连接错误、429 与 5xx 可以重试 (或换模型)；参数错误、鉴权失败等重试也没用"""
+    import httpx
+
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, httpx.TimeoutException, httpx.TransportError)):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    try:
+        import openai
+    except ImportError:
+        return False
+    return isinstance(error, (openai.APITimeoutError, openai.APIConnectionError))
+
+
+def backoff_delay(attempt: int) -> float:
+    """指数退避 + 全抖动 (full jitter)：在 [0, base * 2^attempt] 内随机，避免大量请求同时重试"""
+    return random.uniform(0, min(config.UPSTREAM_BACKOFF_MAX, config.UPSTREAM_BACKOFF_BASE * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    按模型的熔断器：连续失败达到阈值后熔断 (open)，期间直接跳过该模型；
+    CIRCUIT_RESET_TIMEOUT 秒后放行一个探测请求 (half_open)，成功则恢复，失败则继续熔断。
+    """
+
+    STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+        set_gauge("ecommate_circuit_state", {"model": name}, 0)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._set_state("half_open")
+            if self.state == "half_open":
+                # 探测请求超过 reset_timeout 仍无结果 (例如被取消后没有释放) 时视为作废，允许新的探测
+                if self._probing and time.monotonic() - self._probe_started < self.reset_timeout:
+                    return False
+                self._probing = True
+                self._probe_started = time.monotonic()
+            return True
+
+    def release(self) -> None:
+        """请求被取消 / 中断：不计成功或失败，只归还探测名额"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            if self.state != "closed":
+                self._set_state("closed")
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == "half_open" or (self.state == "closed" and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self._set_state("open")
+
+    def _set_state(self, state: str) -> None:
+        print(f"熔断器 {self.name}: {self.state} -> {state}")
+        self.state = state
+        set_gauge("ecommate_circuit_state", {"model": self.name}, self.STATES[state])
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(model: str) -> CircuitBreaker:
+    breaker = _breakers.get(model)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(model)
+            if breaker is None:
+                breaker = CircuitBreaker(model, config.CIRCUIT_FAILURE_THRESHOLD, config.CIRCUIT_RESET_TIMEOUT)
+                _breakers[model] = breaker
+    return breaker
+
+
+class LatencyTracker:
+    """最近若干次成功调用的耗时，用于计算对冲请求 (hedged request) 的触发时间"""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+def hedge_delay(tracker: LatencyTracker) -> float:
+    """
+    VISION_HEDGE_AFTER=p95 时按最近的 p95 耗时 (样本不足时不对冲)，填数字则为固定秒数，0 关闭。
+    """
+    setting = config.VISION_HEDGE_AFTER
+    if setting == "p95":
+        delay = tracker.p95()
+    else:
+        delay = float(setting or 0)
+    if not delay:
+        return 0.0
+    return max(delay, config.VISION_HEDGE_MIN_DELAY)
+
+
+class HedgeBudget:
+    """
+    对冲请求的额度：每个请求存入 ratio 个额度 (上限 burst)，每次对冲消耗 1 个，
+    对冲请求最多占全部请求的 ratio。上游整体变慢、几乎所有请求都超过 p95 时不会让流量翻倍。
+    """
+
+    def __init__(self, ratio: float, burst: float = 5.0):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = burst
+        self._lock = threading.Lock()
+
+    def deposit(self) -> bool:
+        """记录一个新请求，返回当前是否还有对冲额度"""
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.ratio)
+            return self._tokens >= 1
+
+    def take(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+_hedge_budget = None
+_hedge_slots = None
+_hedge_executor = None
+_hedge_lock = threading.Lock()
+
+
+def _get_hedge_pool():
+    """对冲请求专用线程池；信号量与线程数相同，没有空闲线程时不对冲，对冲请求不会排队"""
+    global _hedge_budget, _hedge_slots, _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_lock:
+            if _hedge_executor is None:
+                _hedge_budget = HedgeBudget(config.VISION_HEDGE_MAX_RATIO)
+                _hedge_slots = threading.BoundedSemaphore(config.HEDGE_MAX_WORKERS)
+                _hedge_executor = ThreadPoolExecutor(max_workers=config.HEDGE_MAX_WORKERS, thread_name_prefix="hedge")
+    return _hedge_budget, _hedge_slots, _hedge_executor
+
+
+def _should_hedge(tracker: LatencyTracker, model: str = None) -> float:
+    """返回对冲等待秒数；未开启、熔断器不是 closed 或对冲额度用完时返回 0"""
+    delay = hedge_delay(tracker)
+    if not delay:
+        return 0.0
+    if model is not None and get_breaker(model).state != "closed":
+        # 上游已经在出错，此时应减少请求而不是加倍
+        return 0.0
+    budget, _, _ = _get_hedge_pool()
+    return delay if budget.deposit() else 0.0
+
+
+def _timed(func: Callable, tracker: LatencyTracker):
+    start = time.perf_counter()
+    result = func()
+    tracker.add(time.perf_counter() - start)
+    return result
+
+
+def _run_in_thread(func: Callable, *args) -> Future:
+    """在独立线程中执行 (不经过线程池，不会排队)，并复制当前 context，埋点仍记到当前 trace"""
+    future = Future()
+    context = contextvars.copy_context()
+
+    def run():
+        try:
+            future.set_result(context.run(func, *args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="hedge-primary", daemon=True).start()
+    return future
+
+
+def hedged_call(func: Callable, tracker: LatencyTracker, record: dict, model: str = None, timeout: float = None):
+    """
+    先发一个请求，超过 hedge_delay 仍未返回时再发一个相同的请求，取先成功的结果。
+    不满足对冲条件 (_should_hedge) 时直接在调用方线程执行；
+    可能对冲时主请求在独立线程执行，对冲请求只在专用线程池有空闲时发出。
+    timeout 为本次调用 (含对冲) 最多等待的秒数，超时抛出 TimeoutError。
+    同步版本无法中断落后的请求，它会在后台跑完 (结果丢弃)。
+    """
+    delay = _should_hedge(tracker, model)
+    if not delay or (timeout is not None and delay >= timeout):
+        return _timed(func, tracker)
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def remaining():
+        return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+    budget, slots, executor = _get_hedge_pool()
+    primary = _run_in_thread(_timed, func, tracker)
+    done, _ = wait([primary], timeout=delay)
+    if done:
+        return primary.result()
+    if (model is not None and get_breaker(model).state != "closed") or not slots.acquire(blocking=False):
+        return primary.result(timeout=remaining())
+    if not budget.take():
+        slots.release()
+        return primary.result(timeout=remaining())
+
+    record["hedged"] = True
+    print(f"请求超过 {delay:.1f}s 未返回，发出对冲请求")
+    backup = executor.submit(contextvars.copy_context().run, _timed, func, tracker)
+    backup.add_done_callback(lambda _: slots.release())
+    pending, error = {primary, backup}, None
+    while pending:
+        done, pending = wait(pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+        if not done:
+            raise TimeoutError(f"请求 {timeout:.1f}s 内未返回")
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+async def _atimed(func: Callable, tracker: LatencyTracker):
+    start = time.perf_counter()
+    result = await func()
+    tracker.add(time.perf_counter() - start)
+    return result
+
+
+async def ahedged_call(func: Callable, tracker: LatencyTracker, record: dict, model: str = None, timeout: float = None):
+    """
+    hedged_call 的异步版本 (同样受对冲额度与熔断状态限制)，先返回的请求胜出后取消另一个。
+    总时长由调用方 (acall_upstream 的 wait_for) 限制，timeout 只用来判断是否还来得及对冲。
+    """
+    delay = _should_hedge(tracker, model)
+    if not delay or (timeout is not None and delay >= timeout):
+        return await _atimed(func, tracker)
+
+    budget, _, _ = _get_hedge_pool()
+    primary = asyncio.ensure_future(_atimed(func, tracker))
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+    except BaseException:
+        primary.cancel()
+        raise
+    if done:
+        return primary.result()
+    if (model is not None and get_breaker(model).state != "closed") or not budget.take():
+        return await primary
+
+    record["hedged"] = True
+    print(f"请求超过 {delay:.1f}s 未返回，发出对冲请求")
+    pending, error = {primary, asyncio.ensure_future(_atimed(func, tracker))}, None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def _on_failure(record: dict, model: str, attempt: int, error: BaseException, started: float):
+    """记录一次失败，返回重试前的等待秒数；不应再重试当前模型时返回 None"""
+    breaker = get_breaker(model)
+    breaker.record_failure()
+    if attempt >= config.UPSTREAM_MAX_RETRIES or breaker.state == "open":
+        print(f"{model} 调用失败 ({type(error).__name__}: {error})，不再重试该模型")
+        return None
+    delay = backoff_delay(attempt)
+    if time.monotonic() - started + delay > config.UPSTREAM_DEADLINE:
+        return None
+    record["retries"] = record.get("retries", 0) + 1
+    print(f"{model} 调用失败 ({type(error).__name__}: {error})，{delay:.1f}s 后第 {attempt + 1} 次重试")
+    return delay
+
+
+def _attempt_timeout(started: float, timeout: float = None) -> float:
+    """本次尝试可用的秒数：单次请求超时与整体截止时间剩余部分取小"""
+    remaining = config.UPSTREAM_DEADLINE - (time.monotonic() - started)
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def call_upstream(models: List[str], func: Callable, record: dict = None, timeout: float = None):
+    """
+    依次尝试 models (主模型 + 降级模型)：每个模型按 UPSTREAM_MAX_RETRIES 做带抖动的指数退避重试，
+    熔断中的模型直接跳过，整体不超过 UPSTREAM_DEADLINE。
+    func(model, attempt_timeout) 执行一次调用，attempt_timeout 为 min(timeout, 截止时间剩余秒数)，
+    应作为这次请求的超时传给客户端，保证临近截止时间发起的请求也不会超时太多。
+    重试次数、降级到的模型写入 record (所在 span 的埋点)。
+    """
+    record = {} if record is None else record
+    started = time.monotonic()
+    last_error = None
+    for index, model in enumerate(models):
+        breaker = get_breaker(model)
+        for attempt in range(config.UPSTREAM_MAX_RETRIES + 1):
+            attempt_timeout = _attempt_timeout(started, timeout)
+            if attempt_timeout <= 0:
+                break
+            if not breaker.allow():
+                record["breaker_skipped"] = record.get("breaker_skipped", 0) + 1
+                break
+            try:
+                result = func(model, attempt_timeout)
+            except Exception as e:
+                if not is_retryable(e):
+                    # 服务端正常响应了 (只是请求本身有问题)，不计入熔断
+                    breaker.record_success()
+                    raise
+                last_error = e
+                delay = _on_failure(record, model, attempt, e, started)
+                if delay is None:
+                    break
+                time.sleep(delay)
+                continue
+            except BaseException:
+                breaker.release()
+                raise
+            breaker.record_success()
+            if index:
+                record["fallback_model"] = model
+                print(f"已降级到备用模型 {model}")
+            return result
+    raise UpstreamError(f"模型服务暂不可用 ({' / '.join(models)}): {last_error or '熔断中'}") from last_error
+
+
+async def acall_upstream(models: List[str], func: Callable, record: dict = None, timeout: float = None):
+    """
+    call_upstream 的异步版本，func(model, attempt_timeout) 返回协程；
+    每次尝试另外用 asyncio.wait_for 强制限时 (连同对冲请求一起取消)。
+    """
+    record = {} if record is None else record
+    started = time.monotonic()
+    last_error = None
+    for index, model in enumerate(models):
+        breaker = get_breaker(model)
+        for attempt in range(config.UPSTREAM_MAX_RETRIES + 1):
+            attempt_timeout = _attempt_timeout(started, timeout)
+            if attempt_timeout <= 0:
+                break
+            if not breaker.allow():
+                record["breaker_skipped"] = record.get("breaker_skipped", 0) + 1
+                break
+            try:
+                try:
+                    result = await asyncio.wait_for(func(model, attempt_timeout), attempt_timeout)
+                except asyncio.TimeoutError as e:
+                    raise TimeoutError(f"请求 {attempt_timeout:.1f}s 内未返回") from e
+            except Exception as e:
+                if not is_retryable(e):
+                    breaker.record_success()
+                    raise
+                last_error = e
+                delay = _on_failure(record, model, attempt, e, started)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # 取消 (客户端断开、对冲请求落败) 不是上游故障，但半开状态下必须归还探测名额
+                breaker.release()
+                raise
+            breaker.record_success()
+            if index:
+                record["fallback_model"] = model
+                print(f"已降级到备用模型 {model}")
+            return result
+    raise UpstreamError(f"模型服务暂不可用 ({' / '.join(models)}): {last_error or '熔断中'}") from last_error
+
+
+def stream_upstream(models: List[str], func: Callable, record: dict = None, timeout: float = None):
+    """
+    流式调用：func(model, attempt_timeout) 返回 chunk 迭代器。收到第一个 chunk 之前的失败按 call_upstream 重试 / 降级；
+    已经开始输出后再出错则直接抛出，避免重复输出已展示给用户的内容。
+    整个流 (含首个 chunk 之前的重试) 不超过 UPSTREAM_DEADLINE，超出时中止并抛出 UpstreamError。
+    """
+    deadline = time.monotonic() + config.UPSTREAM_DEADLINE
+
+    def open_stream(model, attempt_timeout):
+        stream = iter(func(model, attempt_timeout))
+        return stream, next(stream, None)
+
+    stream, first = call_upstream(models, open_stream, record, timeout)
+    try:
+        if first is not None:
+            yield first
+        # 单个 chunk 的等待受请求超时约束，这里限制整个流的总时长
+        for chunk in stream:
+            if time.monotonic() > deadline:
+                raise UpstreamError(f"流式输出超出整体截止时间 {config.UPSTREAM_DEADLINE:.0f}s")
+            yield chunk
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+
+
+async def astream_upstream(models: List[str], func: Callable, record: dict = None, timeout: float = None):
+    """stream_upstream 的异步版本，func(model, attempt_timeout) 返回异步迭代器"""
+    deadline = time.monotonic() + config.UPSTREAM_DEADLINE
+
+    async def open_stream(model, attempt_timeout):
+        stream = aiter(func(model, attempt_timeout))
+        return stream, await anext(stream, None)
+
+    stream, first = await acall_upstream(models, open_stream, record, timeout)
+    try:
+        if first is not None:
+            yield first
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise UpstreamError(f"流式输出超出整体截止时间 {config.UPSTREAM_DEADLINE:.0f}s")
+            try:
+                chunk = await asyncio.wait_for(anext(stream), remaining)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError as e:
+                raise UpstreamError(f"流式输出超出整体截止时间 {config.UPSTREAM_DEADLINE:.0f}s") from e
+            yield chunk
+    finally:
+        aclose = getattr(stream, "aclose", None)
+        if aclose is not None:
+            await aclose()
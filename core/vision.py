@@ -1,13 +1,53 @@
+import asyncio
 import base64
+import io
 import os
 import json
 import re
-from typing import List
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage
-from pydantic import BaseModel, Field
-from langchain_core.output_parsers import JsonOutputParser
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import List, Union
+from PIL import Image, ImageOps
+from pydantic import BaseModel, Field, ValidationError
 import config
+from core.cache import SingleFlight, SQLiteCache, hash_bytes
+from core.llm import get_vision_llm, vision_models
+from core.metrics import record_usage, span
+from core.phash import PerceptualIndex, image_fingerprint
+from core.resilience import LatencyTracker, UpstreamError, acall_upstream, ahedged_call, call_upstream, hedged_call
+
+# 修改视觉 Prompt 或 ImageInfo 字段时递增，旧缓存自动失效
+VISION_PROMPT_VERSION = "v2"
+
+_vision_cache = None
+_phash_index = None
+# 最近视觉请求的耗时，p95 作为对冲请求的触发时间
+_vision_latency = LatencyTracker()
+# 按缓存 key 去重进行中的视觉解析
+_vision_inflight = SingleFlight()
+
+class VisionAnalysisError(RuntimeError):
+    """视觉模型不可用 (重试与降级均失败) 或返回内容无法解析"""
+
+def get_vision_cache():
+    global _vision_cache
+    if _vision_cache is None:
+        _vision_cache = SQLiteCache(
+            os.path.join(config.CACHE_DIR, "vision_cache.sqlite3"),
+            ttl=config.VISION_CACHE_TTL,
+            max_entries=config.VISION_CACHE_MAX_ENTRIES,
+        )
+    return _vision_cache
+
+def get_phash_index():
+    global _phash_index
+    if _phash_index is None:
+        _phash_index = PerceptualIndex(
+            os.path.join(config.CACHE_DIR, "vision_phash.sqlite3"),
+            namespace=f"{config.VISION_MODEL_NAME}/{VISION_PROMPT_VERSION}",
+            max_distance=config.PHASH_MAX_DISTANCE,
+            max_color_delta=config.PHASH_MAX_COLOR_DELTA,
+        )
+    return _phash_index
 
 class ImageInfo(BaseModel):
     """图片视觉分析结果"""
@@ -22,27 +62,133 @@ def clean_json_string(json_str):
     cleaned = re.sub(r'```', '', cleaned)
     return cleaned.strip()
 
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+IMAGE_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
 
-def analyze_image(image_path: str) -> dict:
-    if not os.path.exists(image_path):
-        raise FileNotFoundError(f"图片未找到: {image_path}")
+def _flatten_to_rgb(image):
+    """JPEG 不支持透明通道，透明背景铺白"""
+    if image.mode == "RGB":
+        return image
+    background = Image.new("RGB", image.size, (255, 255, 255))
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background.paste(image, mask=image.split()[-1])
+    else:
+        background.paste(image.convert("RGB"))
+    return background
 
-    print(f"正在观察图片: {image_path} ...")
-    
-    parser = JsonOutputParser(pydantic_object=ImageInfo)
-    
-    llm = ChatOpenAI(
-        model=config.VISION_MODEL_NAME,
-        openai_api_key=config.API_KEY,
-        openai_api_base=config.BASE_URL,
-        temperature=0.01,
-        max_tokens=1024
+def make_thumbnail(image_bytes: bytes, max_edge: int = None) -> bytes:
+    """聊天记录展示用的小尺寸 JPEG 缩略图，原图只保存在 core.blobs 中"""
+    max_edge = max_edge or config.THUMBNAIL_MAX_EDGE
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes)))
+    image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    buffer = io.BytesIO()
+    _flatten_to_rgb(image).save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
+
+def preprocess_image(image_bytes: bytes):
+    """
+    发送给视觉模型前压缩图片：按 EXIF 方向摆正后缩放到最长边 VISION_MAX_EDGE，
+    去除 EXIF 并重新编码为 VISION_IMAGE_FORMAT。
+    返回 (处理后的 bytes, MIME 类型, 前后大小统计)。
+    """
+    image_format = config.VISION_IMAGE_FORMAT.upper()
+    original = Image.open(io.BytesIO(image_bytes))
+    original_format = original.format
+    has_exif = len(original.getexif()) > 0
+    image = ImageOps.exif_transpose(original)
+    image.thumbnail((config.VISION_MAX_EDGE, config.VISION_MAX_EDGE), Image.LANCZOS)
+    resized = image.size != original.size
+
+    if image_format == "JPEG":
+        image = _flatten_to_rgb(image)
+
+    buffer = io.BytesIO()
+    # 不传 exif 参数即不写入 EXIF 信息
+    image.save(buffer, format=image_format, quality=config.VISION_IMAGE_QUALITY)
+    processed = buffer.getvalue()
+    mime_type = IMAGE_MIME_TYPES[image_format]
+
+    # 原图已经足够小 (未缩放、无 EXIF、格式受支持) 且重新编码反而更大时，直接发送原图
+    if not resized and not has_exif and len(processed) >= len(image_bytes) and original_format in IMAGE_MIME_TYPES:
+        processed = image_bytes
+        mime_type = IMAGE_MIME_TYPES[original_format]
+
+    stats = {
+        "original_bytes": len(image_bytes),
+        "processed_bytes": len(processed),
+        "size": image.size,
+    }
+    return processed, mime_type, stats
+
+def _read_image(image: Union[str, bytes]):
+    """返回 (图片字节, 日志里显示的名字)"""
+    if isinstance(image, bytes):
+        return image, f"<{len(image)} bytes>"
+    if not os.path.exists(image):
+        raise FileNotFoundError(f"图片未找到: {image}")
+    with open(image, "rb") as image_file:
+        return image_file.read(), image
+
+def _lookup_vision_cache(image_bytes: bytes, image_name: str):
+    """返回 (缓存 key, 缓存结果或 None)"""
+    # 同一张图换风格/篇幅重新生成时，直接复用之前的解析结果
+    # 预处理参数会影响模型看到的图片，因此也计入 key
+    cache_key = hash_bytes(
+        image_bytes, config.VISION_MODEL_NAME, VISION_PROMPT_VERSION,
+        f"{config.VISION_MAX_EDGE}/{config.VISION_IMAGE_FORMAT}/{config.VISION_IMAGE_QUALITY}",
     )
+    with span("vision.cache") as m:
+        cached = get_vision_cache().get(cache_key)
+        m["cache_hit"] = cached is not None
+    if cached is not None:
+        print(f"命中视觉解析缓存: {image_name}")
+    return cache_key, cached
+
+def _lookup_similar(image_bytes: bytes, image_name: str, cache_key: str):
+    """
+    精确缓存未命中时，按感知哈希查找近似重复 (重拍 / 裁剪 / 重新压缩) 的已解析图片。
+    返回 (图片指纹, 复用的解析结果或 None)；指纹用于模型解析成功后写入索引。
+    """
+    if not config.PHASH_INDEX:
+        return None, None
+    with span("vision.phash") as m:
+        try:
+            fingerprint = image_fingerprint(image_bytes)
+        except Exception as e:
+            print(f"感知哈希计算失败: {e}")
+            m["cache_hit"] = False
+            return None, None
+        match = get_phash_index().lookup(*fingerprint)
+        m["cache_hit"] = match is not None
+        if match is not None:
+            m["phash_distance"], m["color_delta"] = match[1], match[2]
+    if match is None:
+        return fingerprint, None
+
+    result, distance, color_delta = match
+    print(f"近似图片复用视觉解析结果: {image_name} (Hamming 距离 {distance}，颜色差 {color_delta})")
+    # 同一张图再次出现时直接命中精确缓存
+    get_vision_cache().set(cache_key, result)
+    return fingerprint, result
+
+def _remember(cache_key: str, fingerprint, result: dict) -> None:
+    """只缓存成功解析的结果，失败的兜底字典不入缓存"""
+    get_vision_cache().set(cache_key, result)
+    if fingerprint is not None:
+        get_phash_index().add(*fingerprint, cache_key, result)
+
+def _build_vision_message(image_bytes: bytes):
+    """预处理图片并拼装多模态消息，返回 (message, base64 载荷长度)"""
+    processed_bytes, mime_type, stats = preprocess_image(image_bytes)
+    print(f"图片预处理: {stats['original_bytes'] / 1024:.0f}KB -> {stats['processed_bytes'] / 1024:.0f}KB, 尺寸 {stats['size']}")
 
-    base64_image = encode_image(image_path)
+    # langchain_core 的消息与解析器在首次调用时才导入，import core.vision 保持轻量
+    from langchain_core.messages import HumanMessage
+    from langchain_core.output_parsers import JsonOutputParser
+
+    parser = JsonOutputParser(pydantic_object=ImageInfo)
+
+    base64_image = base64.b64encode(processed_bytes).decode('utf-8')
 
     format_instructions = parser.get_format_instructions()
     
@@ -58,29 +204,148 @@ def analyze_image(image_path: str) -> dict:
             {"type": "text", "text": prompt_text},
             {
                 "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
+                "image_url": {"url": f"data:{mime_type};base64,{base64_image}"},
             },
         ]
     )
+    return message, len(base64_image)
+
+def fallback_attributes(error: Exception) -> dict:
+    """视觉解析失败时工作流使用的占位属性，带上失败原因，便于前端 / 调用方识别"""
+    return {
+        "description": "图片解析失败",
+        "style": "未知",
+        "color_palette": [],
+        "material": "未知",
+        "target_audience": "未知",
+        "error": str(error),
+    }
+
+def _parse_result(content: str) -> dict:
+    """解析并按 ImageInfo 校验模型输出；不符合结构的结果 (列表、缺字段等) 同样视为失败，不进缓存"""
+    try:
+        return ImageInfo.model_validate(json.loads(clean_json_string(content))).model_dump()
+    except (json.JSONDecodeError, ValidationError) as e:
+        print(f"模型原始返回: {content}")
+        raise VisionAnalysisError(f"视觉模型返回的内容无法解析: {e}") from e
 
+def _finish(record: dict, response, cache_key: str, fingerprint) -> dict:
+    parsed_result = _parse_result(response.content)
+    if record.get("fallback_model"):
+        # 降级模型的结果不进缓存，主模型恢复后重新解析
+        print(f"视觉解析使用了备用模型 {record['fallback_model']}，结果不缓存")
+    else:
+        _remember(cache_key, fingerprint, parsed_result)
+    return parsed_result
+
+def analyze_image(image: Union[str, bytes]) -> dict:
+    """
+    image 可以是图片路径，也可以是内存中的图片字节流 (前端上传的 bytes)。
+    模型调用带超时、重试、降级与对冲请求 (core.resilience)，最终失败时抛出 VisionAnalysisError。
+    同一张图片同时只解析一次，并发的相同请求 (如批量任务里同一张图的多种风格) 等待并共享结果。
+    """
+    image_bytes, image_name = _read_image(image)
+    cache_key, cached = _lookup_vision_cache(image_bytes, image_name)
+    if cached is not None:
+        return cached
+
+    future, is_leader = _vision_inflight.begin(cache_key)
+    if not is_leader:
+        try:
+            # 领头请求解析失败时这里抛出同样的 VisionAnalysisError，不再重复调用上游
+            shared = future.result(timeout=config.UPSTREAM_DEADLINE)
+        except FutureTimeoutError:
+            shared = None
+        if shared is not None:
+            print(f"复用进行中的视觉解析: {image_name}")
+            return shared
+        return _analyze_uncached(image_bytes, image_name, cache_key)
+
+    result = None
     try:
-        response = llm.invoke([message])
-        content = response.content
-        
-        cleaned_content = clean_json_string(content)
-        parsed_result = json.loads(cleaned_content)
-        
-        return parsed_result
-        
-    except Exception as e:
-        print(f"视觉解析失败: {e}")
-        if 'content' in locals():
-            print(f"模型原始返回: {content}")
-            
-        return {
-            "description": "图片解析失败",
-            "style": "未知",
-            "color_palette": [],
-            "material": "未知",
-            "target_audience": "未知"
-        }
\ No newline at end of file
+        result = _analyze_uncached(image_bytes, image_name, cache_key)
+        return result
+    except VisionAnalysisError as e:
+        _vision_inflight.finish(cache_key, error=e)
+        raise
+    finally:
+        # 被中断等其它异常时等待者拿到 None，各自重新解析
+        _vision_inflight.finish(cache_key, result)
+
+def _analyze_uncached(image_bytes: bytes, image_name: str, cache_key: str) -> dict:
+    fingerprint, similar = _lookup_similar(image_bytes, image_name, cache_key)
+    if similar is not None:
+        return similar
+
+    print(f"正在观察图片: {image_name} ...")
+    message, payload_bytes = _build_vision_message(image_bytes)
+
+    with span("vision.call", payload_bytes=payload_bytes) as m:
+        try:
+            response = call_upstream(
+                vision_models(),
+                lambda model, t: hedged_call(
+                    lambda: get_vision_llm(model).invoke([message], timeout=t), _vision_latency, m, model, t
+                ),
+                m,
+                config.VISION_LLM_TIMEOUT,
+            )
+        except UpstreamError as e:
+            raise VisionAnalysisError(f"视觉解析失败: {e}") from e
+        record_usage(m, response)
+    return _finish(m, response, cache_key, fingerprint)
+
+async def aanalyze_image(image: Union[str, bytes]) -> dict:
+    """
+    analyze_image 的异步版本：图片预处理 (CPU) 放到线程池，模型调用走 ainvoke，
+    等待视觉模型的几秒钟内不占用线程。与同步版本共用进行中请求去重。
+    """
+    image_bytes, image_name = _read_image(image)
+    cache_key, cached = _lookup_vision_cache(image_bytes, image_name)
+    if cached is not None:
+        return cached
+
+    future, is_leader = _vision_inflight.begin(cache_key)
+    if not is_leader:
+        try:
+            # shield：当前请求被取消不影响共享的 future
+            shared = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), config.UPSTREAM_DEADLINE)
+        except asyncio.TimeoutError:
+            shared = None
+        if shared is not None:
+            print(f"复用进行中的视觉解析: {image_name}")
+            return shared
+        return await _aanalyze_uncached(image_bytes, image_name, cache_key)
+
+    result = None
+    try:
+        result = await _aanalyze_uncached(image_bytes, image_name, cache_key)
+        return result
+    except VisionAnalysisError as e:
+        _vision_inflight.finish(cache_key, error=e)
+        raise
+    finally:
+        _vision_inflight.finish(cache_key, result)
+
+async def _aanalyze_uncached(image_bytes: bytes, image_name: str, cache_key: str) -> dict:
+    fingerprint, similar = await asyncio.to_thread(_lookup_similar, image_bytes, image_name, cache_key)
+    if similar is not None:
+        return similar
+
+    print(f"正在观察图片: {image_name} ...")
+    message, payload_bytes = await asyncio.to_thread(_build_vision_message, image_bytes)
+
+    with span("vision.call", payload_bytes=payload_bytes) as m:
+        try:
+            response = await acall_upstream(
+                vision_models(),
+                lambda model, t: ahedged_call(
+                    lambda: get_vision_llm(model).ainvoke([message], timeout=t), _vision_latency, m, model, t
+                ),
+                m,
+                config.VISION_LLM_TIMEOUT,
+            )
+        except UpstreamError as e:
+            raise VisionAnalysisError(f"视觉解析失败: {e}") from e
+        record_usage(m, response)
+    return _finish(m, response, cache_key, fingerprint)
@@ -1,14 +1,40 @@
-from typing import TypedDict, List, Dict
-from langgraph.graph import StateGraph, END
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import TypedDict, List, Dict, Tuple, Union
 
-from core.llm import get_llm
-from core.vision import analyze_image
-from core.rag import retrieve_examples
+import config
+
+from core.blobs import get_image
+from core.cache import SingleFlight, SQLiteCache, hash_bytes
+from core.embeddings import embedding_model_id
+from core.llm import get_llm, text_models
+from core.metrics import record_usage, span, timed
+from core.prompt import build_generation_messages
+from core.resilience import astream_upstream, stream_upstream
+from core.vision import VISION_PROMPT_VERSION, aanalyze_image, analyze_image, fallback_attributes
+from core.rag import aretrieve_examples, retrieve_examples
+
+# 生成 Prompt 有改动时递增，旧的生成结果缓存随之失效
+GENERATION_PROMPT_VERSION = "v2"
+
+# 生成结果缓存只保存这些输出字段，图片字节不进缓存
+_CACHED_FIELDS = ("image_data", "retrieved_examples", "final_copy")
+# 等待进行中的相同请求的最长时间，超时后自己执行
+_INFLIGHT_WAIT_SECONDS = 300
+
+_generation_cache = None
+_generation_inflight = SingleFlight()
 
 # 定义State
 class AgentState(TypedDict):
     # 用户输入
     image_path: str        
+    image_bytes: bytes  # 内存中的图片字节流，存在时优先于 image_path，免去临时文件读写
+    image_ref: str  # core.blobs 中的图片引用 (内容哈希)；State 里只传引用，不随节点复制整张图片
     user_style: str
     words_limit: str  # FourthCommit新增修改: 接收用户要求生成文案长度的量       
     user_note: str  # refactor: 接收用户特定需求
@@ -17,42 +43,88 @@ class AgentState(TypedDict):
     retrieved_examples: List[str] 
     # 模型输出
     final_copy: str 
+    vision_failed: bool  # 视觉解析失败，文案基于占位属性生成
+    degraded: bool  # 使用了降级模型或视觉解析失败，结果不进生成缓存
+
+def load_image(state: Dict) -> Union[str, bytes]:
+    """按 image_bytes > image_ref > image_path 的优先级取图片 (字节流或路径)"""
+    if state.get('image_bytes'):
+        return state['image_bytes']
+    if state.get('image_ref'):
+        try:
+            return get_image(state['image_ref'])
+        except KeyError as e:
+            # KeyError 的 str() 带引号，转成 LookupError 使占位属性里的失败原因可读
+            raise LookupError(e.args[0]) from None
+    return state['image_path']
 
 # 定义Nodes
+@timed("node.vision_step")
 def vision_node(state: AgentState) -> Dict:
     """
     节点：视觉解析
-    输入：image_path
+    输入：image_bytes / image_ref / image_path
     输出：更新 image_data
     """
-    print(f"\n [Vision Node] 正在解析图片: {state['image_path']} ...")
+    print(f"\n [Vision Node] 正在解析图片: {state.get('image_path') or '内存图片'} ...")
     
     try:
-        attributes = analyze_image(state['image_path'])
+        # image_ref 可能已被 BlobStore 淘汰 (KeyError)，同样按视觉解析失败处理
+        attributes = analyze_image(load_image(state))
     except Exception as e:
-        print(f"视觉模块报错: {e}，使用默认空值")
-        attributes = {"description": "未知商品", "style": "未知", "color": "未知"}
+        # 不中断流程，按风格照常生成；占位属性带失败原因，结果标记为降级、不进缓存
+        print(f"视觉模块报错: {e}，使用占位属性")
+        return {"image_data": fallback_attributes(e), "vision_failed": True}
     
     # 返回的内容会合并到 State 中
-    return {"image_data": attributes}
+    return {"image_data": attributes, "vision_failed": False}
+
+@timed("node.vision_step")
+async def avision_node(state: AgentState) -> Dict:
+    """vision_node 的异步版本，供 ainvoke / astream 使用"""
+    print(f"\n [Vision Node] 正在解析图片: {state.get('image_path') or '内存图片'} ...")
+
+    try:
+        attributes = await aanalyze_image(load_image(state))
+    except Exception as e:
+        print(f"视觉模块报错: {e}，使用占位属性")
+        return {"image_data": fallback_attributes(e), "vision_failed": True}
 
+    return {"image_data": attributes, "vision_failed": False}
+
+@timed("node.retrieve_step")
 def retrieve_node(state: AgentState) -> Dict:
     """
     节点：RAG 检索
-    输入：user_style
+    输入：user_style (开启语义检索时还有 image_data)
     输出：更新 retrieved_examples
     """
     style = state['user_style']
     print(f"\n [Retrieval Node] 正在检索风格: {style} ...")
     
     try:
-        examples = retrieve_examples(style, k=3)
+        examples = retrieve_examples(style, k=config.RAG_TOP_K, image_data=state.get('image_data'))
     except Exception as e:
         print(f"RAG 模块报错: {e}，使用默认空值")
         examples = ["暂无参考范例"]
         
     return {"retrieved_examples": examples}
 
+@timed("node.retrieve_step")
+async def aretrieve_node(state: AgentState) -> Dict:
+    """retrieve_node 的异步版本"""
+    style = state['user_style']
+    print(f"\n [Retrieval Node] 正在检索风格: {style} ...")
+
+    try:
+        examples = await aretrieve_examples(style, k=config.RAG_TOP_K, image_data=state.get('image_data'))
+    except Exception as e:
+        print(f"RAG 模块报错: {e}，使用默认空值")
+        examples = ["暂无参考范例"]
+
+    return {"retrieved_examples": examples}
+
+@timed("node.generate_step")
 def generate_node(state: AgentState) -> Dict:
     """
     节点：文案生成
@@ -60,59 +132,368 @@ def generate_node(state: AgentState) -> Dict:
     输出：更新 final_copy
     """
     print("\n [Generation Node] 正在生成最终文案 ...")
+    # 固定 system 前缀 + 紧凑的商品信息，范例按 token 预算截断
+    messages, stats = build_generation_messages(state)
+
+    # 3. 调用 LLM，输出上限按字数要求收紧
+    with span("llm.generate") as m:
+        m.update(stats)
+        # 逐块接收并累加，首个非空 token 到达的时间即 TTFT；
+        # stream_workflow 的 messages 模式也是从这里拿到实时 token
+        start = time.perf_counter()
+        response = None
+        # 首个 token 之前的失败会重试 / 降级 (core.resilience)
+        stream = stream_upstream(
+            text_models(),
+            lambda model, t: get_llm(model).stream(messages, max_tokens=stats["max_tokens"], timeout=t),
+            m,
+            config.TEXT_LLM_TIMEOUT,
+        )
+        for chunk in stream:
+            if chunk.content and "ttft" not in m:
+                m["ttft"] = round(time.perf_counter() - start, 4)
+            response = chunk if response is None else response + chunk
+        record_usage(m, response)
     
-    # 1. 获取所有上下文
-    attrs = state['image_data']
-    examples = "\n".join([f"- {ex}" for ex in state['retrieved_examples']])
-    style = state['user_style']
-    limit = state.get('words_limit', '适中')  # FourthCommit新增有关文案长度的量
-    note = state.get('user_note', '无') # refactor: 获取用户备注
-    
-    # refactor: 增强Prompt
-    prompt = f"""
-    你是一个金牌电商文案撰写专家。请根据以下信息撰写一篇吸引人的营销文案。
+    return {"final_copy": response.content, "degraded": bool(m.get("fallback_model") or state.get("vision_failed"))}
 
-    【商品视觉信息】：
-    {attrs}
+@timed("node.generate_step")
+async def agenerate_node(state: AgentState) -> Dict:
+    """generate_node 的异步版本：astream 逐块接收，等待 token 期间不占用线程"""
+    print("\n [Generation Node] 正在生成最终文案 ...")
+    messages, stats = build_generation_messages(state)
 
-    【用户指定风格】：
-    {style}
+    with span("llm.generate") as m:
+        m.update(stats)
+        start = time.perf_counter()
+        response = None
+        stream = astream_upstream(
+            text_models(),
+            lambda model, t: get_llm(model).astream(messages, max_tokens=stats["max_tokens"], timeout=t),
+            m,
+            config.TEXT_LLM_TIMEOUT,
+        )
+        async for chunk in stream:
+            if chunk.content and "ttft" not in m:
+                m["ttft"] = round(time.perf_counter() - start, 4)
+            response = chunk if response is None else response + chunk
+        record_usage(m, response)
 
-    【长度要求】： 
-    {limit}
-    
-    【用户特别要求】：{note}  <-- 必须优先满足这一点
-    【字数限制】：严格控制在 {limit} 字以内 (宁缺毋滥)
+    return {"final_copy": response.content, "degraded": bool(m.get("fallback_model") or state.get("vision_failed"))}
 
-    【参考高分范例】（请学习其语气、结构，但不要照抄）：
-    {examples}
-    
-    【要求】：
-    1. 必须符合指定的“{style}”风格。
-    2. 突出商品的视觉亮点（如颜色、材质）。
-    3. 不要用“YYDS”“绝绝子”这类泛滥词。
-    4. 输出格式清晰，不要包含“根据以上信息...”等废话，直接输出文案内容
+# 生成结果缓存
+def get_generation_cache():
+    global _generation_cache
+    if _generation_cache is None:
+        _generation_cache = SQLiteCache(
+            os.path.join(config.CACHE_DIR, "generation_cache.sqlite3"),
+            ttl=config.GENERATION_CACHE_TTL,
+            max_entries=config.GENERATION_CACHE_MAX_ENTRIES,
+        )
+    return _generation_cache
+
+def image_digest(inputs: Dict) -> str:
+    """图片内容哈希；image_ref 本身就是内容哈希，无需重新计算"""
+    if not inputs.get('image_bytes') and inputs.get('image_ref'):
+        return inputs['image_ref']
+    image = load_image(inputs)
+    if isinstance(image, str):
+        with open(image, "rb") as f:
+            image = f.read()
+    return hash_bytes(image)
+
+def generation_cache_key(digest: str, user_style: str, words_limit: str, user_note: str) -> str:
     """
+    生成结果缓存 key：图片哈希 + 全部用户输入 + 影响输出的模型 / Prompt 版本与检索配置
+    """
+    return hash_bytes(
+        digest, user_style, str(words_limit or ""), user_note or "",
+        config.MODEL_NAME, config.VISION_MODEL_NAME, VISION_PROMPT_VERSION, GENERATION_PROMPT_VERSION,
+        embedding_model_id(), str(config.RAG_TOP_K), str(config.RAG_SEMANTIC_RETRIEVAL),
+    )
 
-    # 3. 调用 LLM
-    llm = get_llm()
-    response = llm.invoke(prompt)  
-    
-    return {"final_copy": response.content}
+def _is_cacheable(state: Dict) -> bool:
+    """视觉解析走了兜底或生成失败的结果不缓存，下次请求重新生成"""
+    copy = state.get('final_copy') or ""
+    description = (state.get('image_data') or {}).get("description")
+    return bool(copy) and not copy.startswith("生成出错") and description not in ("未知商品", "图片解析失败")
+
+def _lookup_generation(key: str):
+    """
+    查缓存，未命中时加入进行中请求去重。
+    返回 (缓存 / 共享的输出字段 或 None, 是否由当前调用方负责执行)。
+    """
+    with span("generation.cache") as m:
+        cached = get_generation_cache().get(key)
+        m["cache_hit"] = cached is not None
+    if cached is not None:
+        return cached, False
+    return _join_inflight(key)
+
+async def _alookup_generation(key: str):
+    """_lookup_generation 的异步版本，等待进行中的相同请求时不阻塞事件循环"""
+    with span("generation.cache") as m:
+        cached = get_generation_cache().get(key)
+        m["cache_hit"] = cached is not None
+    if cached is not None:
+        return cached, False
+
+    future, is_leader = _generation_inflight.begin(key)
+    if is_leader:
+        return None, True
+    try:
+        # shield：当前请求被取消或等待超时只影响自己，共享的 future 仍由领头请求完成，
+        # 否则取消会传递到 future 上，其它等待者与领头请求都会跟着失败
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), _INFLIGHT_WAIT_SECONDS), False
+    except asyncio.TimeoutError:
+        return None, False
+
+def _join_inflight(key: str):
+    future, is_leader = _generation_inflight.begin(key)
+    if is_leader:
+        return None, True
+    try:
+        # 领头的请求失败或被中断时结果为 None，由当前请求自己执行
+        return future.result(timeout=_INFLIGHT_WAIT_SECONDS), False
+    except FutureTimeoutError:
+        return None, False
+
+def _store_generation(key: str, state: Dict) -> Dict:
+    """写入生成缓存 (降级结果除外)，返回共享给进行中相同请求的输出字段"""
+    outputs = {field: state.get(field) for field in _CACHED_FIELDS}
+    degraded = bool(state.get('degraded') or state.get('vision_failed'))
+    if _is_cacheable(outputs) and not degraded:
+        get_generation_cache().set(key, outputs)
+    return {**outputs, "degraded": degraded, "vision_failed": bool(state.get('vision_failed'))}
 
 # Graph Construction
-def create_workflow():
+def create_workflow(parallel: bool = True):
+    """
+    parallel=True（默认）：视觉解析与 RAG 检索并行执行，二者都完成后再进入生成节点；
+    parallel=False：保留原来的串行流程，便于做耗时对比。
+    开启 RAG_SEMANTIC_RETRIEVAL 时检索依赖视觉结果，只能串行。
+    """
+    # langgraph 导入约 1 秒，只在编译工作流时才导入
+    from langchain_core.runnables import RunnableLambda
+    from langgraph.graph import StateGraph, START, END
+
     workflow = StateGraph(AgentState)
     
-    workflow.add_node("vision_step", vision_node)
-    workflow.add_node("retrieve_step", retrieve_node)
-    workflow.add_node("generate_step", generate_node)
+    # 每个节点同时注册同步与异步实现：invoke / stream 走同步版本，ainvoke / astream 走异步版本
+    workflow.add_node("vision_step", RunnableLambda(vision_node, afunc=avision_node, name="vision_step"))
+    workflow.add_node("retrieve_step", RunnableLambda(retrieve_node, afunc=aretrieve_node, name="retrieve_step"))
+    workflow.add_node("generate_step", RunnableLambda(generate_node, afunc=agenerate_node, name="generate_step"))
     
-    # 流程：Start -> Vision -> Retrieve -> Generate -> End
-    workflow.set_entry_point("vision_step")
-    workflow.add_edge("vision_step", "retrieve_step")
-    workflow.add_edge("retrieve_step", "generate_step")
+    if parallel and not config.RAG_SEMANTIC_RETRIEVAL:
+        # 流程：Start -> (Vision || Retrieve) -> Generate -> End
+        # 两个节点写入的 State 字段互不重叠 (image_data / retrieved_examples)，合并无冲突
+        workflow.add_edge(START, "vision_step")
+        workflow.add_edge(START, "retrieve_step")
+        workflow.add_edge(["vision_step", "retrieve_step"], "generate_step")
+    else:
+        # 流程：Start -> Vision -> Retrieve -> Generate -> End
+        workflow.set_entry_point("vision_step")
+        workflow.add_edge("vision_step", "retrieve_step")
+        workflow.add_edge("retrieve_step", "generate_step")
     workflow.add_edge("generate_step", END)
     
     app = workflow.compile()
-    return app
\ No newline at end of file
+    return app
+
+# 编译后的图是无状态的，可以在所有会话之间共享，只需编译一次
+_compiled_workflows = {}
+_compiled_workflows_lock = threading.Lock()
+
+def get_workflow(parallel: bool = True):
+    """
+    获取进程内共享的已编译工作流，避免每次生成都重新编译 StateGraph。
+    """
+    app = _compiled_workflows.get(parallel)
+    if app is None:
+        with _compiled_workflows_lock:
+            app = _compiled_workflows.get(parallel)
+            if app is None:
+                app = create_workflow(parallel=parallel)
+                _compiled_workflows[parallel] = app
+    return app
+
+def run_batch(image: Union[str, bytes], variants: List[Tuple[str, str, str]], max_concurrency: int = None,
+              regenerate: bool = False) -> List[Dict]:
+    """
+    一图多风格批量生成 (image 为图片路径或内存字节流)：
+    1. 已缓存的变体直接返回 (regenerate=True 时跳过缓存)；
+    2. 图片只做一次视觉解析；
+    3. 每种风格各检索一次范例；
+    4. 各变体的文案生成并发执行，并发数受 max_concurrency 限制。
+    variants: [(user_style, words_limit, user_note), ...]
+    返回与 variants 顺序一致的结果 State 列表。
+    """
+    max_concurrency = max_concurrency or config.BATCH_MAX_CONCURRENCY
+    if isinstance(image, bytes):
+        image_inputs = {"image_path": "", "image_bytes": image}
+    else:
+        image_inputs = {"image_path": image}
+
+    states = [
+        {
+            **image_inputs,
+            "user_style": style,
+            "words_limit": words_limit,
+            "user_note": user_note,
+            "image_data": {},
+            "retrieved_examples": [],
+            "final_copy": "",
+        }
+        for style, words_limit, user_note in variants
+    ]
+
+    keys = [None] * len(states)
+    if config.GENERATION_CACHE:
+        digest = image_digest(image_inputs)
+        keys = [generation_cache_key(digest, *variant) for variant in variants]
+        if not regenerate:
+            cache = get_generation_cache()
+            for state, key in zip(states, keys):
+                cached = cache.get(key)
+                if cached is not None:
+                    state.update(cached)
+    pending = [i for i, state in enumerate(states) if not state["final_copy"]]
+    if not pending:
+        return states
+
+    styles = list(dict.fromkeys(states[i]["user_style"] for i in pending))
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(styles) + 1))) as pool:
+        # 视觉解析与各风格的检索互不依赖时一起提交；语义检索则要等视觉结果
+        # 每个任务复制一份 context，子线程里的埋点仍记到当前请求的 trace
+        vision_future = pool.submit(contextvars.copy_context().run, vision_node, image_inputs)
+        if config.RAG_SEMANTIC_RETRIEVAL:
+            image_data = vision_future.result()["image_data"]
+        else:
+            image_data = {}
+        retrieve_futures = {
+            style: pool.submit(contextvars.copy_context().run, retrieve_node, {"user_style": style, "image_data": image_data})
+            for style in styles
+        }
+        vision = vision_future.result()
+        image_data, vision_failed = vision["image_data"], vision.get("vision_failed", False)
+        examples = {style: future.result()["retrieved_examples"] for style, future in retrieve_futures.items()}
+
+    def generate(i):
+        state = {**states[i], "image_data": image_data, "vision_failed": vision_failed,
+                 "retrieved_examples": examples[states[i]["user_style"]]}
+        key, is_leader = keys[i], False
+        if key and not regenerate:
+            shared, is_leader = _join_inflight(key)
+            if shared is not None:
+                return {**state, **shared}
+        outputs = None
+        try:
+            state.update(generate_node(state))
+        except Exception as e:
+            # 单个变体失败不影响其它风格的结果
+            print(f"批量生成报错 ({state['user_style']}): {e}")
+            state["final_copy"] = f"生成出错: {e}"
+        finally:
+            if key:
+                outputs = _store_generation(key, state)
+            if is_leader:
+                _generation_inflight.finish(key, outputs)
+        return state
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, generate, i) for i in pending]
+        for i, future in zip(pending, futures):
+            states[i] = future.result()
+    return states
+
+def _stream_graph(app, inputs: Dict):
+    final_state = dict(inputs)
+    for mode, chunk in app.stream(inputs, stream_mode=["updates", "messages", "values"]):
+        if mode == "updates":
+            for node_name in chunk:
+                yield ("step", node_name)
+        elif mode == "messages":
+            message, metadata = chunk
+            if metadata.get("langgraph_node") == "generate_step" and message.content:
+                yield ("token", message.content)
+        else:
+            final_state = chunk
+    yield ("done", final_state)
+
+def stream_workflow(app, inputs: Dict, regenerate: bool = False):
+    """
+    流式运行工作流，逐个产出事件：
+    ("step", 节点名)      —— 某个节点执行完毕，可用于更新前端进度；
+    ("token", 文本片段)   —— generate_step 中 LLM 实时返回的 token；
+    ("cached", None)      —— 命中生成结果缓存，或复用了同时进行中的相同请求，随后直接 done；
+    ("done", 最终 State)  —— 整个流程结束。
+    regenerate=True 时跳过缓存与请求去重，重新生成并覆盖缓存。
+    """
+    if not config.GENERATION_CACHE:
+        yield from _stream_graph(app, inputs)
+        return
+
+    key = generation_cache_key(image_digest(inputs), inputs['user_style'],
+                               inputs.get('words_limit'), inputs.get('user_note'))
+    is_leader = False
+    if not regenerate:
+        shared, is_leader = _lookup_generation(key)
+        if shared is not None:
+            yield ("cached", None)
+            yield ("done", {**inputs, **shared})
+            return
+
+    outputs = None
+    try:
+        for kind, payload in _stream_graph(app, inputs):
+            if kind == "done":
+                outputs = _store_generation(key, payload)
+            yield (kind, payload)
+    finally:
+        # 无论成功与否都要唤醒等待中的相同请求；失败时它们拿到 None 后自行执行
+        if is_leader:
+            _generation_inflight.finish(key, outputs)
+
+async def _astream_graph(app, inputs: Dict):
+    final_state = dict(inputs)
+    async for mode, chunk in app.astream(inputs, stream_mode=["updates", "messages", "values"]):
+        if mode == "updates":
+            for node_name in chunk:
+                yield ("step", node_name)
+        elif mode == "messages":
+            message, metadata = chunk
+            if metadata.get("langgraph_node") == "generate_step" and message.content:
+                yield ("token", message.content)
+        else:
+            final_state = chunk
+    yield ("done", final_state)
+
+async def astream_workflow(app, inputs: Dict, regenerate: bool = False):
+    """
+    stream_workflow 的异步版本 (事件格式相同)，各节点走异步实现，
+    单个进程可以同时服务大量生成请求而不必每个请求占用一个线程。
+    """
+    if not config.GENERATION_CACHE:
+        async for event in _astream_graph(app, inputs):
+            yield event
+        return
+
+    key = generation_cache_key(image_digest(inputs), inputs['user_style'],
+                               inputs.get('words_limit'), inputs.get('user_note'))
+    is_leader = False
+    if not regenerate:
+        shared, is_leader = await _alookup_generation(key)
+        if shared is not None:
+            yield ("cached", None)
+            yield ("done", {**inputs, **shared})
+            return
+
+    outputs = None
+    try:
+        async for kind, payload in _astream_graph(app, inputs):
+            if kind == "done":
+                outputs = _store_generation(key, payload)
+            yield (kind, payload)
+    finally:
+        if is_leader:
+            _generation_inflight.finish(key, outputs)
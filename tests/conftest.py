@@ -0,0 +1,22 @@
+import os
+import shutil
+import sys
+import tempfile
+
+# 直接运行 pytest 时也能 import core / config
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# 缓存与埋点写到临时目录，不污染 data/cache；需在 import config 之前设置
+_CACHE_DIR = tempfile.mkdtemp(prefix="ecommate-tests-")
+os.environ["CACHE_DIR"] = _CACHE_DIR
+os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(_CACHE_DIR, "embeddings.sqlite3")
+os.environ["METRICS_SQLITE_PATH"] = os.path.join(_CACHE_DIR, "metrics.sqlite3")
+
+
+def pytest_sessionfinish(session, exitstatus):
+    metrics = sys.modules.get("core.metrics")
+    if metrics is not None:
+        metrics.flush_metrics()
+    shutil.rmtree(_CACHE_DIR, ignore_errors=True)
@@ -0,0 +1,31 @@
+import asyncio
+import os
+
+from core import workflow
+from core.cache import SQLiteCache
+
+
+def test_cancelled_waiter_does_not_cancel_shared_request(tmp_path):
+    """一个等待者被取消 (如 SSE 客户端断开) 后，其它等待者和领头请求仍能拿到结果"""
+    workflow._generation_cache = SQLiteCache(os.path.join(tmp_path, "generation.sqlite3"), ttl=0, max_entries=0)
+    key = "inflight-cancel"
+
+    async def scenario():
+        shared, is_leader = await workflow._alookup_generation(key)
+        assert shared is None and is_leader
+
+        cancelled = asyncio.create_task(workflow._alookup_generation(key))
+        waiter = asyncio.create_task(workflow._alookup_generation(key))
+        await asyncio.sleep(0.05)
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        assert cancelled.cancelled()
+
+        outputs = {"final_copy": "文案"}
+        workflow._generation_inflight.finish(key, outputs)
+        return await asyncio.wait_for(waiter, 5)
+
+    try:
+        assert asyncio.run(scenario()) == ({"final_copy": "文案"}, False)
+    finally:
+        workflow._generation_cache = None
@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+import pytest
+
+import config
+from core.resilience import CircuitBreaker, HedgeBudget, UpstreamError, acall_upstream, call_upstream
+
+
+def test_breaker_opens_after_threshold_and_recovers_after_probe():
+    breaker = CircuitBreaker("test-open", failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.allow() and breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    time.sleep(0.06)
+    # 熔断到期后只放行一个探测请求
+    assert breaker.allow() and breaker.state == "half_open"
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_breaker_failed_probe_reopens():
+    breaker = CircuitBreaker("test-reopen", failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+
+def test_breaker_release_and_stale_probe_free_the_probe_slot():
+    breaker = CircuitBreaker("test-release", failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow() and not breaker.allow()
+    # 探测请求被取消：归还名额，不改变状态
+    breaker.release()
+    assert breaker.state == "half_open" and breaker.allow()
+    # 探测请求一直没有结果：超过 reset_timeout 后允许新的探测
+    time.sleep(0.06)
+    assert breaker.allow()
+
+
+def test_hedge_budget_limits_hedges_to_ratio():
+    budget = HedgeBudget(ratio=0.25, burst=2)
+    assert budget.take() and budget.take()
+    assert not budget.take()
+
+    # 每个请求存入 0.25 个额度：3 个请求后仍不足 1 个，第 4 个请求后可以对冲一次
+    assert not any(budget.deposit() for _ in range(3))
+    assert budget.deposit()
+    assert budget.take() and not budget.take()
+
+    # 额度不超过 burst
+    for _ in range(100):
+        budget.deposit()
+    assert budget.take() and budget.take() and not budget.take()
+
+
+def test_call_upstream_passes_remaining_deadline_as_timeout(monkeypatch):
+    monkeypatch.setattr(config, "UPSTREAM_DEADLINE", 0.5)
+    timeouts = []
+
+    def func(model, timeout):
+        timeouts.append(timeout)
+        return "ok"
+
+    assert call_upstream(["test-timeout"], func, timeout=30) == "ok"
+    assert 0 < timeouts[0] <= 0.5
+
+
+def test_acall_upstream_bounds_each_attempt(monkeypatch):
+    monkeypatch.setattr(config, "UPSTREAM_DEADLINE", 0.3)
+    monkeypatch.setattr(config, "UPSTREAM_MAX_RETRIES", 0)
+
+    async def hang(model, timeout):
+        await asyncio.sleep(10)
+
+    started = time.monotonic()
+    with pytest.raises(UpstreamError):
+        asyncio.run(acall_upstream(["test-hang"], hang, timeout=30))
+    assert time.monotonic() - started < 2
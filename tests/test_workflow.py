@@ -0,0 +1,11 @@
+import asyncio
+
+from core.workflow import avision_node, vision_node
+
+
+def test_vision_node_degrades_when_image_ref_was_evicted():
+    """BlobStore 中已淘汰的 image_ref 按视觉解析失败处理，而不是让请求报错"""
+    state = {"image_ref": "0" * 64, "image_path": ""}
+    for update in (vision_node(state), asyncio.run(avision_node(state))):
+        assert update["vision_failed"] is True
+        assert update["image_data"]["error"].startswith("图片已过期或不存在")